@@ -0,0 +1,98 @@
+# projects フォルダのプロジェクトをまとめてコンパイルし、musics フォルダに出力する
+# 使い方: python batch_compile.py [--workers N] [--force] [--compact]
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import time
+
+from system import project_file
+from system import sounds
+
+MANIFEST_PATH = "./user/compile_manifest.json"
+
+
+def load_json(name):
+    try:
+        fin = open(f"./user/{name}", "rt", encoding="utf-8")
+    except:
+        fin = open(f"./system/{name}", "rt", encoding="utf-8")
+    with fin:
+        return json.loads(fin.read())
+
+
+def get_hash(items, tones, patterns, is_compact):
+    data = json.dumps([items, tones, patterns, is_compact], separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def compile_project(path, tones, patterns, manifest_hash, is_compact):
+    start = time.perf_counter()
+    project = os.path.splitext(os.path.basename(path))[0]
+    out_path = f"./musics/{project}.json"
+    items = project_file.load(path).to_items()
+    digest = get_hash(items, tones, patterns, is_compact)
+    if digest == manifest_hash and os.path.exists(out_path):
+        return project, digest, None
+    music = sounds.compile(items, tones, patterns, backend="numpy")
+    if is_compact:
+        music = sounds.compact(music)
+    with open(out_path, "wt", encoding="utf-8") as fout:
+        fout.write(json.dumps(music))
+    return project, digest, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile all projects to musics.")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="ignore the cache")
+    parser.add_argument(
+        "--compact", action="store_true", help="write run-length encoded musics"
+    )
+    args = parser.parse_args()
+    tones = load_json("tones.json")
+    patterns = load_json("patterns.json")
+    manifest = {}
+    if not args.force and os.path.exists(MANIFEST_PATH):
+        with open(MANIFEST_PATH, "rt", encoding="utf-8") as fin:
+            manifest = json.loads(fin.read())
+    files = []
+    for ext in project_file.EXTENSIONS:
+        files += glob.glob(f"./projects/*{ext}")
+    files.sort()
+    start = time.perf_counter()
+    compiled = 0
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+        jobs = [
+            executor.submit(
+                compile_project,
+                path,
+                tones,
+                patterns,
+                manifest.get(path),
+                args.compact,
+            )
+            for path in files
+        ]
+        for path, job in zip(files, jobs):
+            try:
+                project, digest, elapsed = job.result()
+            except Exception as e:
+                print(f"[ERROR] {path}: {e}")
+                continue
+            manifest[path] = digest
+            if elapsed is None:
+                print(f"{project:<16} skipped")
+            else:
+                compiled += 1
+                print(f"{project:<16} {elapsed:7.3f} sec")
+    with open(MANIFEST_PATH, "wt", encoding="utf-8") as fout:
+        fout.write(json.dumps(manifest, indent=2))
+    elapsed = time.perf_counter() - start
+    print(f"{compiled}/{len(files)} compiled in {elapsed:.3f} sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+# sounds.compile の計測用スクリプト
+# リポジトリのルートで `python benchmarks/bench_compile.py` を実行してください。
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from system import sounds
+from projects import make_project
+
+SIZES = (625, 1250, 2500, 5000, 10000)
+# 長く伸ばした音符と休符が中心になるように、ノートをまばらに置く
+DENSITY = 0.02
+
+
+def main():
+    with open("./system/tones.json", "rt", encoding="utf-8") as fin:
+        tones = json.loads(fin.read())
+    with open("./system/patterns.json", "rt", encoding="utf-8") as fin:
+        patterns = json.loads(fin.read())
+    for rows in SIZES:
+        items = make_project(rows, DENSITY, drums=False)
+        start = time.perf_counter()
+        timeline = sounds.make_timeline(items)
+        for ch in range(4):
+            sounds.make_channel_rows(items, ch, timeline)
+        index = time.perf_counter() - start
+        start = time.perf_counter()
+        sounds.compile(items, tones, patterns)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{rows:>6} rows: index {index:7.3f} sec, compile {elapsed:7.3f} sec "
+            f"({elapsed / rows * 1e6:.1f} us/row)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+# sounds.compile の python 版と numpy 版の比較
+# リポジトリのルートで `python benchmarks/bench_numpy.py` を実行してください。
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from system import sounds
+
+SCALE = 50
+
+
+def main():
+    if sounds.np is None:
+        print("NumPy is not installed.")
+        return
+    with open("./system/tones.json", "rt", encoding="utf-8") as fin:
+        tones = json.loads(fin.read())
+    with open("./system/patterns.json", "rt", encoding="utf-8") as fin:
+        patterns = json.loads(fin.read())
+    with open("./projects/sample.json", "rt", encoding="utf-8") as fin:
+        items = json.loads(fin.read()) * SCALE
+    results = {}
+    for backend in ("python", "numpy"):
+        start = time.perf_counter()
+        results[backend] = sounds.compile(items, tones, patterns, backend=backend)
+        elapsed = time.perf_counter() - start
+        print(f"{backend:>6}: {elapsed:7.3f} sec ({len(items)} rows)")
+    print("identical:", results["python"] == results["numpy"])
+
+
+if __name__ == "__main__":
+    main()
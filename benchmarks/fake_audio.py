@@ -0,0 +1,94 @@
+# PyAudio互換の偽の入力デバイス（録音によるwavエクスポートを実機なしで試すため）
+# 開いてからdelay_sec後にpcm（16ビットのモノラル）を流し、前後は小さなノイズを返す
+# is_realtime=Falseなら待たずにコールバックを呼び続ける
+# stop_secを指定すると、その時間分を流したところで止まる（デバイスが外れたときなど）
+import array
+import random
+import threading
+import time
+
+from system import wav_export
+
+
+class FakeAudio:
+    def __init__(
+        self, pcm, sample_rate, delay_sec=0.2, is_realtime=False, stop_sec=None
+    ):
+        self.pcm = array.array("h", pcm)
+        self.sample_rate = sample_rate
+        self.delay_sec = delay_sec
+        self.is_realtime = is_realtime
+        self.stop_sec = stop_sec
+        rand = random.Random(0)
+        # 検出の閾値より十分小さいノイズ
+        self.noise = array.array(
+            "h", [rand.randint(-8, 8) for _ in range(wav_export.DEFAULT_CHUNK)]
+        )
+
+    def get_device_count(self):
+        return 1
+
+    def get_device_info_by_index(self, index):
+        return {
+            "index": 0,
+            "name": "Fake Loopback",
+            "maxInputChannels": 1,
+            "defaultSampleRate": self.sample_rate,
+        }
+
+    def get_default_input_device_info(self):
+        return self.get_device_info_by_index(0)
+
+    def open(self, rate, frames_per_buffer, stream_callback, **kwargs):
+        return FakeStream(self, rate, frames_per_buffer, stream_callback)
+
+    def terminate(self):
+        pass
+
+    # pos〜pos+countフレームの内容
+    def read(self, pos, count):
+        data = array.array("h", self.noise[:count])
+        start = int(self.delay_sec * self.sample_rate)
+        first = max(pos, start)
+        last = min(pos + count, start + len(self.pcm))
+        if first < last:
+            data[first - pos : last - pos] = self.pcm[first - start : last - start]
+        return data.tobytes()
+
+
+class FakeStream:
+    def __init__(self, audio, rate, frames_per_buffer, callback):
+        self.is_running = True
+        self.thread = threading.Thread(
+            target=self.run,
+            args=(audio, rate, frames_per_buffer, callback),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def run(self, audio, rate, frames_per_buffer, callback):
+        pos = 0
+        # コールバックが例外を出したらPortAudioと同じく止める
+        try:
+            while self.is_running:
+                data = audio.read(pos, frames_per_buffer)
+                pos += frames_per_buffer
+                (_, flag) = callback(data, frames_per_buffer, {}, 0)
+                if flag != wav_export.PA_CONTINUE:
+                    break
+                if not audio.stop_sec is None and pos >= audio.stop_sec * rate:
+                    break
+                if audio.is_realtime:
+                    time.sleep(frames_per_buffer / rate)
+        finally:
+            self.is_running = False
+
+    def is_active(self):
+        return self.is_running
+
+    def stop_stream(self):
+        self.is_running = False
+        self.thread.join()
+
+    def close(self):
+        pass
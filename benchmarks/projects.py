@@ -0,0 +1,33 @@
+# 計測用の合成プロジェクト（items形式の19列の行データ）の生成
+import random
+
+DRUM_KEYS = (":1", ":2", ":3", ":5", ":6", ":7")
+
+
+# rows: 行数、density: 各チャンネルにノートを置く確率、
+# tempo_changes: テンポ変更の回数、drums: 4チャンネル目をドラムパターンにするか
+def make_project(rows, density=0.3, tempo_changes=0, drums=True, seed=0):
+    rnd = random.Random(seed)
+    tempo_rows = set(rnd.sample(range(1, rows), min(tempo_changes, rows - 1)))
+    items = []
+    for row in range(rows):
+        item = [None for _ in range(19)]
+        if row == 0:
+            item[0] = 240
+            item[1] = 48
+            item[2] = 6
+        elif row in tempo_rows:
+            item[0] = rnd.choice([168, 200, 240, 288])
+        for ch in range(4):
+            col = 3 + ch * 4
+            if row == 0 or rnd.random() < density / 8:
+                item[col] = rnd.randrange(16)
+                item[col + 1] = rnd.randrange(1, 8)
+                item[col + 2] = rnd.randrange(8, 17)
+            if row == 0 or rnd.random() < density:
+                if drums and ch == 3:
+                    item[col + 3] = rnd.choice(DRUM_KEYS)
+                else:
+                    item[col + 3] = rnd.choice([-1] + list(range(12, 48)))
+        items.append(item)
+    return items
@@ -0,0 +1,237 @@
+# 計測スイート
+# リポジトリのルートで `python benchmarks/run.py [--out FILE]` を実行してください。
+# 結果はJSONで出力されるので、リビジョン間で比較できます。
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from projects import make_project
+
+SIZES = (100, 1000, 5000, 20000)
+
+
+# ウィンドウを開かずにeditor.Appを使うためのpyxelのスタブ
+def make_pyxel_stub():
+    stub = types.ModuleType("pyxel")
+    stub.frame_count = 0
+    stub.mouse_wheel = 0
+
+    def noop(*args, **kwargs):
+        return None
+
+    def getattr(name):
+        if name.startswith("KEY_"):
+            return hash(name) & 0xFFFF
+        return noop
+
+    class Image:
+        def __init__(self, *args):
+            pass
+
+        def __getattr__(self, name):
+            return noop
+
+    stub.__getattr__ = getattr
+    stub.Image = Image
+    stub.Sound = Image
+    stub.sounds = [Image() for _ in range(4)]
+    stub.btn = lambda *args: False
+    stub.btnp = lambda *args: False
+    return stub
+
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# 作成したオブジェクトが確保しているメモリ量
+def measure_memory(func):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    obj = func()
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del obj
+    return size
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def run(sizes, repeat):
+    sys.modules["pyxel"] = make_pyxel_stub()
+    import editor
+    from system import sounds
+    from system import song
+    from system import project_file
+    from system import synth
+    from system import wav_export
+    from fake_audio import FakeAudio
+
+    app = editor.App()
+    results = []
+    for rows in sizes:
+        items = make_project(rows, tempo_changes=rows // 500)
+        app.items = song.Song(items)
+        app.set_locs()
+        app.pos = rows // 2
+        app.crow1 = rows // 2
+        result = {"rows": rows}
+        result["items_bytes"] = measure_memory(lambda: copy.deepcopy(items))
+        result["song_bytes"] = measure_memory(lambda: song.Song(items))
+        result["to_items"] = measure(app.items.to_items, repeat)
+        json_data = project_file.dumps(app.items, "bench.json").encode("utf-8")
+        binary_data = project_file.dumps_binary(app.items)
+        result["json_file_bytes"] = len(json_data)
+        result["binary_file_bytes"] = len(binary_data)
+        result["json_save"] = measure(
+            lambda: project_file.dumps(app.items, "bench.json"), repeat
+        )
+        result["binary_save"] = measure(
+            lambda: project_file.dumps_binary(app.items), repeat
+        )
+        result["json_load"] = measure(
+            lambda: song.Song(json.loads(json_data.decode("utf-8"))), repeat
+        )
+        result["binary_load"] = measure(
+            lambda: project_file.loads_binary(binary_data), repeat
+        )
+        result["compile"] = measure(
+            lambda: sounds.compile(items, app.tones, app.patterns), 1
+        )
+        # wavのオフライン合成（曲の長さと比べる）
+        music = sounds.compile(items, app.tones, app.patterns)
+        result["song_seconds"] = synth.get_total_ticks(music) / synth.TICKS_PER_SECOND
+        result["render_wav"] = measure(lambda: synth.render(music), 1)
+        # チャンネルごとに別プロセスで合成（CPUが1つなら直列と同じ）
+        with wav_export._make_executor() as executor:
+            result["render_wav_parallel"] = measure(
+                lambda: synth.render(music, executor=executor), 1
+            )
+        # 小節ごとのキャッシュを作ってから、1小節だけ変えて合成し直す
+        bar_ticks = sounds.get_bar_ticks(items)
+        edited = copy.deepcopy(items)
+        row = next(row for row in range(rows // 2, rows) if edited[row][6] is not None)
+        edited[row][6] += 1
+        edited_music = sounds.compile(edited, app.tones, app.patterns)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            synth.render(music, bar_ticks=bar_ticks, cache_dir=cache_dir)
+            result["render_wav_edit_cached"] = measure(
+                lambda: synth.render(
+                    edited_music, bar_ticks=bar_ticks, cache_dir=cache_dir
+                ),
+                1,
+            )
+        # 偽の入力デバイスから録音して書き出す（待たずに読み込む）
+        pcm = synth.render(music).tobytes()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.wav")
+            result["record_wav"] = measure(
+                lambda: wav_export.record_compiled_music_to_wav(
+                    music, path, FakeAudio(pcm, synth.SAMPLE_RATE)
+                ),
+                1,
+            )
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "bench.mid")
+                result["make_midi"] = measure(
+                    lambda: sounds.make_midi(items, path), repeat
+                )
+        except NameError:
+            result["make_midi"] = None  # mido未インストール
+        result["set_locs"] = measure(app.set_locs, repeat)
+        result["set_item"] = measure(
+            lambda: app.set_item(rows // 2, 3, (app.items.get(rows // 2, 3) or 0) ^ 1),
+            repeat,
+        )
+
+        def auto_delete_rows():
+            empty_rows = [copy.deepcopy(editor.item_empty) for _ in range(48)]
+            app.items.insert(len(app.items), empty_rows)
+            app.set_locs()
+            start = time.perf_counter()
+            app.auto_delete_rows()
+            return time.perf_counter() - start
+
+        result["auto_delete_rows"] = min(auto_delete_rows() for _ in range(repeat))
+        result["push_pool"] = measure(app.push_pool, repeat)
+        result["draw_notes"] = measure(app.draw_notes, repeat)
+
+        def draw_notes_full():
+            app.grid_keys = [None] * 25
+            app.draw_notes()
+
+        result["draw_notes_full"] = measure(draw_notes_full, repeat)
+
+        # 先頭から再生を始めるまでの時間（保存の書き出しは含まない）
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ("projects", "musics", "user"):
+                os.mkdir(os.path.join(tmp, name))
+            app.outpath = tmp
+            app.project = "bench"
+            app.crow1 = 0
+
+            def init_play():
+                app.saver.flush()
+                start = time.perf_counter()
+                app.init_play()
+                return time.perf_counter() - start
+
+            result["init_play"] = min(init_play() for _ in range(repeat))
+            app.saver.flush()
+        results.append(result)
+        print(
+            " ".join(
+                f"{key}={value:.4f}" if type(value) is float else f"{key}={value}"
+                for key, value in result.items()
+            )
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmark suite.")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--sizes", type=int, nargs="*", default=SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    results = run(args.sizes, args.repeat)
+    with open(args.out, "wt", encoding="utf-8") as fout:
+        fout.write(
+            json.dumps(
+                {
+                    "revision": get_revision(),
+                    "python": platform.python_version(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "results": results,
+                },
+                indent=2,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
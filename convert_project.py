@@ -0,0 +1,19 @@
+# プロジェクトファイルをjson形式とバイナリ形式（.pxtr）の間で変換する
+# 使い方: python convert_project.py projects/sample.json projects/sample.pxtr
+import argparse
+
+from system import project_file
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a project file between json and binary (.pxtr)."
+    )
+    parser.add_argument("src")
+    parser.add_argument("dst")
+    args = parser.parse_args()
+    project_file.convert(args.src, args.dst)
+
+
+if __name__ == "__main__":
+    main()
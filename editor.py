@@ -2,10 +2,15 @@ import pyxel as px
 import json
 import os
 import copy
-import glob
 
 from system import util
 from system import sounds
+from system import timeline
+from system import history
+from system import song
+from system import saver
+from system import project_file
+from system import project_index
 from system import midi_input
 from system import wav_export
 
@@ -33,14 +38,29 @@ class App:
             fin = open("./system/patterns.json", "rt", encoding="utf-8")
         finally:
             self.patterns = json.loads(fin.read())
-        self.pool = []
-        self.redo_items = []
+        self.history = history.History()
+        self.saver = saver.Saver()
+        self.items = song.Song()
         self.music = []
+        self.compiler = sounds.Compiler()
+        self.chunks = None
+        self.chunk_sounds = []
+        self.compiled_chunks = set()
+        self.compact_music = os.getenv("PYXEL_TRACKER_COMPACT_MUSIC") == "1"
+        # 新しく作るプロジェクトの形式（読み込んだプロジェクトはその形式で保存する）
+        if os.getenv("PYXEL_TRACKER_BINARY_PROJECT") == "1":
+            self.default_project_ext = project_file.BINARY_EXT
+        else:
+            self.default_project_ext = project_file.JSON_EXT
+        self.project_ext = self.default_project_ext
         self.is_file_load = False
         self.is_file_save = False
         self.is_playing = False
+        # 再生音を録音してwavを書き出している間のwav_export.Recorder
+        self.recorder = None
         self.is_help_mode = False
         self.files = []
+        self.file_index = project_index.load()
         self.file_cursol = 0
         self.file_pos = 0
         self.playing_row = 0
@@ -71,14 +91,24 @@ class App:
         self.confirm_cursol = None
         self.buffer = None
         self.flash_pat = False
+        # グリッドとピアノは画像に描いておき、変化した部分だけ描き直す
+        self.grid_image = px.Image(256, 208)
+        self.grid_keys = [None] * 25
+        self.piano_image = px.Image(256, 24)
+        self.piano_image.camera(0, 232)
+        self.piano_cache_key = None
         self.init_items()
         self.message = "Press [esc] to show help."
         px.run(self.update, self.draw)
 
     def update(self):
         self.is_cmd = px.btn(px.KEY_GUI) or px.btn(px.KEY_CTRL)
+        if self.saver.pop_error():
+            self.message = "Failed to save."
         if self.confirm_action:
             return self.manage_confirm()
+        if self.recorder:
+            return self.manage_recorder()
         if self.is_help_mode:
             return self.update_help()
         if self.is_file_load or self.is_file_save:
@@ -111,6 +141,8 @@ class App:
                 self.draw_params()
         if self.confirm_txt:
             self.draw_confirm()
+        if self.recorder:
+            self.draw_recorder()
 
     # ===============================================
     # システム機能
@@ -131,36 +163,28 @@ class App:
             self.is_file_load = True
         if px.btnp(px.KEY_E) and self.project:
             try:
-                sounds.make_midi(self.items, f"{self.outpath}/midi/{self.project}.mid")
+                sounds.make_midi(
+                    self.items.to_items(), f"{self.outpath}/midi/{self.project}.mid"
+                )
                 self.message = "Exported midi file."
             except:
                 self.message = "Failed export midi file."
         if px.btnp(px.KEY_R) and self.project:
-            try:
-                compiled = sounds.compile(self.items, self.tones, self.patterns)
-                wav_export.export_compiled_music_to_wav(
-                    compiled, f"{self.outpath}/audio/{self.project}.wav"
-                )
-                self.message = "Exported wav file."
-            except Exception as e:
-                print(f"[ERROR] WAV export failed: {e}")
-                self.message = "Failed export wav file."
+            self.export_wav()
+        if px.btnp(px.KEY_S) and self.project:
+            self.export_wav(True)
         if px.btnp(px.KEY_Z):
-            if self.pool:
-                self.redo_items.append(self.items)
-                self.items = self.pool.pop()
-                self.set_locs()
-                self.fix_cursor_row()
+            result = self.history.undo(self.items)
+            if result:
+                self.apply_history(result)
                 self.message = "Undoed."
                 self.add_crow(0)
             else:
                 self.message = "Cannot undo."
         if px.btnp(px.KEY_Y):
-            if self.redo_items:
-                self.pool.append(self.items)
-                self.items = self.redo_items.pop()
-                self.set_locs()
-                self.fix_cursor_row()
+            result = self.history.redo(self.items)
+            if result:
+                self.apply_history(result)
                 self.message = "Redoed."
                 self.add_crow(0)
             else:
@@ -200,8 +224,8 @@ class App:
                     target_col = base_col + col
                     if target_row == 0 and target_col <= 2 and value is None:
                         continue
-                    self.items[target_row][target_col] = value
-            self.set_locs()
+                    self.history.set_cell(self.items, target_row, target_col, value)
+            self.set_locs(self.crow1, last_row)
             self.add_crow(len(self.buffer))
             self.message = "Pasted."
         if px.btnp(px.KEY_O, 10, 2):
@@ -209,35 +233,90 @@ class App:
         if px.btnp(px.KEY_I, 10, 2):
             self.transpose(-1)
 
+    # is_stems=Trueならチャンネルごとに audio/<project>_chN.wav に書き出す
+    def export_wav(self, is_stems=False):
+        try:
+            items = self.items.to_items()
+            compiled = self.compiler.compile(
+                items, self.tones, self.patterns, revision=self.timeline.revision
+            )
+            path = f"{self.outpath}/audio/{self.project}.wav"
+            # 録音する場合は、終わるまでmanage_recorderで少しずつ進める
+            if wav_export.is_recording() and not is_stems:
+                recorder = wav_export.Recorder(compiled, path)
+                recorder.start()
+                self.recorder = recorder
+                self.message = None
+                return
+            wav_export.export_compiled_music_to_wav(
+                compiled, path, is_stems, sounds.get_bar_ticks(items)
+            )
+            self.message = "Exported wav stems." if is_stems else "Exported wav file."
+        except Exception as e:
+            print(f"[ERROR] WAV export failed: {e}")
+            self.message = "Failed export wav file."
+
+    def manage_recorder(self):
+        if px.btnp(px.KEY_ESCAPE):
+            self.recorder.cancel()
+            self.recorder = None
+            self.message = "Canceled export wav file."
+            return
+        try:
+            if not self.recorder.update():
+                return
+            self.message = "Exported wav file."
+        except Exception as e:
+            print(f"[ERROR] WAV export failed: {e}")
+            self.message = "Failed export wav file."
+        self.recorder = None
+
+    def draw_recorder(self):
+        draw_window(64, 108, 128, 40)
+        px.text(68, 112, "Recording wav file...", 7)
+        px.rectb(68, 124, 120, 7, 7)
+        px.rect(69, 125, int(118 * self.recorder.get_progress()), 5, 11)
+        px.text(68, 136, "[esc] Cancel", 7)
+
     def set_files(self):
-        files = glob.glob("./projects/*.json")
-        self.files = [file.split("/")[-1] for file in files]
-        self.files.sort()
+        self.saver.flush()
+        # 変更されたプロジェクトだけ読み直して索引を更新する
+        if project_index.update(self.file_index, "./projects"):
+            index = copy.deepcopy(self.file_index)
+            self.saver.save(project_index.INDEX_PATH, lambda: json.dumps(index))
+        self.files = sorted(os.path.basename(path) for path in self.file_index)
+        self.file_cursol = min(self.file_cursol, max(len(self.files) - 1, 0))
+        self.scroll_files()
 
     def push_pool(self):
-        self.pool.append(copy.deepcopy(self.items))
-        self.redo_items = []
-        if len(self.pool) > 30:
-            self.pool.pop(0)
+        self.history.begin()
+
+    def apply_history(self, result):
+        (self.items, row, last_row) = result
+        if row is None:
+            self.set_locs()
+        else:
+            self.set_locs(row, last_row)
+        self.fix_cursor_row()
 
     def transpose(self, dist):
         (x1, x2, y1, y2) = self.get_x12y12()
         max_row = min(y2, len(self.items) - 1)
-        has_changed = False
+        is_changed = False
         row = y1
         while row <= max_row:
             for idx in range(x2 - x1 + 1):
                 if x1 + idx > 0:
                     col = get_col(x1 + idx) + 3
-                    value = self.items[row][col]
+                    value = self.items.get(row, col)
                     if type(value) is int and value >= 0:
                         new_value = util.range(value, dist, 59, 0)
-                        if new_value != value:
-                            self.items[row][col] = new_value
-                            has_changed = True
+                        if self.history.set_cell(self.items, row, col, new_value):
+                            is_changed = True
             row += 1
-        if has_changed:
-            self.set_locs()
+        # ノートだけの変更でも更新番号を進める（コンパイル結果のキャッシュに使う）
+        if is_changed:
+            self.set_locs(y1, max_row)
 
     # ===============================================
     # ヘルプ
@@ -261,6 +340,10 @@ class App:
                 self.is_file_save = False
             if px.btnp(px.KEY_RETURN):
                 if self.project:
+                    path = project_file.find_path(
+                        "./projects", self.project, self.default_project_ext
+                    )
+                    self.project_ext = os.path.splitext(path)[1]
                     self.init_play()
                 self.is_file_save = False
             tmp_len = len(self.project)
@@ -273,19 +356,15 @@ class App:
             if px.btnp(px.KEY_ESCAPE):
                 self.is_file_load = False
             if px.btnp(px.KEY_RETURN):
-                self.project = (
-                    self.files[self.file_cursol]
-                    .replace(".json", "")
-                    .replace("projects\\", "")
-                )
+                file = self.files[self.file_cursol]
+                (self.project, self.project_ext) = os.path.splitext(file)
                 self.crow1 = 0
                 self.pos = 0
-                with open(
-                    f"./projects/{self.project}.json", "rt", encoding="utf-8"
-                ) as fin:
-                    self.items = json.loads(fin.read())
-                    self.set_locs()
-                    self.message = "File loaded."
+                self.saver.flush()
+                self.history.clear()
+                self.items = project_file.load(f"./projects/{file}")
+                self.set_locs()
+                self.message = "File loaded."
                 self.is_file_load = False
             keep_x = None
             idx = self.file_cursol
@@ -304,25 +383,39 @@ class App:
                     add_x = (4 + keep_x - len(self.files)) % 4
                     idx = len(self.files) - 4 + add_x
             self.file_cursol = idx
+            self.scroll_files()
+
+    # カーソルが見える位置までページを送る
+    def scroll_files(self):
+        row = self.file_cursol // 4
+        top = self.file_pos // 4
+        if row < top:
+            top = row
+        elif row >= top + files_rows:
+            top = row - files_rows + 1
+        self.file_pos = top * 4
 
     def draw_files(self):
-        idx = self.file_pos
-        while idx < len(self.files):
+        # 表示範囲のファイルだけ描く
+        last_idx = min(self.file_pos + files_rows * 4, len(self.files))
+        for idx in range(self.file_pos, last_idx):
             x, y = self.get_files_xy(idx)
-            px.text(x + 2, y + 2, self.files[idx].replace(".json", ""), 7)
-            idx += 1
+            px.text(x + 2, y + 2, os.path.splitext(self.files[idx])[0], 7)
         if self.is_file_load:
             px.text(2, 2, "Select project file", 7)
-            x, y = self.get_files_xy(self.file_cursol)
-            c = 7 if self.flash_pat else 12
-            px.rectb(x, y, 63, 8, c)
+            if self.file_cursol < len(self.files):
+                x, y = self.get_files_xy(self.file_cursol)
+                c = 7 if self.flash_pat else 12
+                px.rectb(x, y, 63, 8, c)
+                info = self.file_index.get(f"./projects/{self.files[self.file_cursol]}")
+                px.text(2, 246, project_index.get_text(info), 6)
         if self.is_file_save:
             px.text(2, 2, "Enter project name > " + self.project, 7)
             if len(self.project) < 15 and self.flash_pat:
                 px.rect(2 + 21 * 4 + len(self.project) * 4, 2, 4, 5, 7)
 
     def get_files_xy(self, idx):
-        return (idx % 4) * 4 * 16, (idx // 4) * 8 + 16
+        return (idx % 4) * 4 * 16, (idx - self.file_pos) // 4 * 8 + 16
 
     # ===============================================
     # プレイヤー
@@ -330,6 +423,8 @@ class App:
 
     def manage_player(self):
         pressed = px.btnp(px.KEY_RETURN) and not self.is_cmd
+        if not self.chunks is None:
+            self.compile_chunk()
         if self.is_playing:
             pos = px.play_pos(0) or px.play_pos(1) or px.play_pos(2) or px.play_pos(3)
             if pos is None:
@@ -340,10 +435,10 @@ class App:
                 self.add_crow(self.playing_row - self.crow1)
                 self.is_playing = False
             else:
-                while self.items_tick[self.playing_row + 1] / 48 <= pos[1] * 120:
+                tick = pos[0] * sounds.CHUNK_TICKS + pos[1] * 120
+                while self.timeline.tick(self.playing_row + 1) / 48 <= tick:
                     self.playing_row += 1
         elif pressed:
-            self.music = sounds.compile(self.items, self.tones, self.patterns)
             if not self.project:
                 self.set_files()
                 self.is_file_save = True
@@ -351,32 +446,74 @@ class App:
             self.init_play()
 
     def init_play(self):
-        with open(
-            f"{self.outpath}/projects/{self.project}.json", "wt", encoding="utf-8"
-        ) as fout:
-            fout.write(json.dumps(self.items))
-        with open(
-            f"{self.outpath}/musics/{self.project}.json", "wt", encoding="utf-8"
-        ) as fout:
-            fout.write(json.dumps(self.music))
-        with open(f"{self.outpath}/user/tones.json", "wt", encoding="utf-8") as fout:
-            fout.write(json.dumps(self.tones))
+        # 保存は別スレッドで行い、すぐに再生を始める
+        saved_items = self.items.copy()
+        saved_tones = copy.deepcopy(self.tones)
+        path = f"{self.outpath}/projects/{self.project}{self.project_ext}"
+        self.saver.save(path, lambda: project_file.dumps(saved_items, path))
+        self.saver.save(
+            f"{self.outpath}/user/tones.json", lambda: json.dumps(saved_tones)
+        )
         self.message = "Saved."
-        for ch, sound in enumerate(self.music):
-            px.sounds[ch].set(*sound)
+        items = self.items.to_items()
+        timeline = sounds.make_timeline(items)
+        # 再生しながら少しずつコンパイルし、区切りごとのサウンドに流し込む
+        # 再生位置の区切りから始め、それより前の区切りは後回しにする
+        self.chunks = self.compiler.compile_chunks(
+            items,
+            self.tones,
+            self.patterns,
+            revision=self.timeline.revision,
+            timeline=timeline,
+            start_tick=self.get_play_tick(self.get_play_row()),
+        )
+        ticks = int(timeline["tick"] / 48)
+        self.chunk_sounds = [[] for _ in range(4)]
+        while ticks > 0:
+            for ch in range(4):
+                sound = px.Sound()
+                sound.set("r" * min(ticks, sounds.CHUNK_TICKS), "p", "0", "n", 1)
+                self.chunk_sounds[ch].append(sound)
+            ticks -= sounds.CHUNK_TICKS
+        self.compiled_chunks = set()
         self.start_play()
         self.is_playing = True
         self.is_range_mode = False
 
+    def compile_chunk(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.chunks = None
+            self.music = self.compiler.music
+            music = sounds.compact(self.music) if self.compact_music else self.music
+            self.saver.save(
+                f"{self.outpath}/musics/{self.project}.json", lambda: json.dumps(music)
+            )
+            return
+        (index, chunk) = chunk
+        for ch, sound in enumerate(chunk):
+            self.chunk_sounds[ch][index].set(*sound)
+        self.compiled_chunks.add(index)
+
     def start_play(self, is_loop=False):
-        if is_loop:
-            row = 0 if self.playing_start is None else self.playing_start
-        else:
-            row = self.crow1 % len(self.items)
-        tick = int(self.items_tick[row] / 48)
+        row = self.get_play_row(is_loop)
+        tick = self.get_play_tick(row)
         self.playing_row = row
+        # 再生位置の区切りと、その次の区切りまではコンパイルしておく
+        index = tick // sounds.CHUNK_TICKS
+        needs = set(range(index, min(index + 2, len(self.chunk_sounds[0]))))
+        while not self.chunks is None and not needs <= self.compiled_chunks:
+            self.compile_chunk()
         for ch in range(4):
-            px.play(ch, [ch], tick=tick)
+            px.play(ch, self.chunk_sounds[ch], tick=tick)
+
+    def get_play_row(self, is_loop=False):
+        if is_loop:
+            return 0 if self.playing_start is None else self.playing_start
+        return self.crow1 % len(self.items)
+
+    def get_play_tick(self, row):
+        return int(self.timeline.tick(row) / 48)
 
     # ===============================================
     # ピアノ
@@ -435,33 +572,40 @@ class App:
         project = (
             f"[{self.project.replace('.json', '')}]" if self.project else "(no name)"
         )
-        px.text(184, 232, project, 12)
-        px.rect(20, 240, 209, 16, 7)
-        for x in range(34):
-            px.line(25 + x * 6, 240, 25 + x * 6, 255, 0)
-        for o in range(5):
-            px.rect(23 + o * 42, 240, 5, 9, 0)
-            px.rect(29 + o * 42, 240, 5, 9, 0)
-            px.rect(41 + o * 42, 240, 5, 9, 0)
-            px.rect(47 + o * 42, 240, 5, 9, 0)
-            px.rect(53 + o * 42, 240, 5, 9, 0)
-        base_x = 21 + self.piano_octave * 42
-        for key, value in dict_playkey.items():
-            octave = self.piano_octave + value[1]
-            if octave >= 0 and octave <= 4:
-                x = base_x + value[2]
-                y = 240 + value[3]
-                if key == self.piano_key:
-                    px.rect(x, y, 3, 5, 11)
-                else:
-                    px.text(x, y, value[4], 11)
-        for idx, pattern in enumerate(self.patterns):
-            x = 20 + idx * 20
-            px.text(x, 232, pattern["abbr"] + pattern["key"], 11)
-        c_rs = 13 if self.piano_octave >= 4 else 11
-        c_ls = 13 if self.piano_octave <= 0 else 11
-        px.text(234, 244, ">>", c_rs)
-        px.text(8, 244, "<<", c_ls)
+        # 変化があったときだけ画像に描き直す
+        cache_key = (project, self.piano_octave, self.piano_key)
+        if cache_key != self.piano_cache_key:
+            self.piano_cache_key = cache_key
+            img = self.piano_image
+            img.cls(0)
+            img.text(184, 232, project, 12)
+            img.rect(20, 240, 209, 16, 7)
+            for x in range(34):
+                img.line(25 + x * 6, 240, 25 + x * 6, 255, 0)
+            for o in range(5):
+                img.rect(23 + o * 42, 240, 5, 9, 0)
+                img.rect(29 + o * 42, 240, 5, 9, 0)
+                img.rect(41 + o * 42, 240, 5, 9, 0)
+                img.rect(47 + o * 42, 240, 5, 9, 0)
+                img.rect(53 + o * 42, 240, 5, 9, 0)
+            base_x = 21 + self.piano_octave * 42
+            for key, value in dict_playkey.items():
+                octave = self.piano_octave + value[1]
+                if octave >= 0 and octave <= 4:
+                    x = base_x + value[2]
+                    y = 240 + value[3]
+                    if key == self.piano_key:
+                        img.rect(x, y, 3, 5, 11)
+                    else:
+                        img.text(x, y, value[4], 11)
+            for idx, pattern in enumerate(self.patterns):
+                x = 20 + idx * 20
+                img.text(x, 232, pattern["abbr"] + pattern["key"], 11)
+            c_rs = 13 if self.piano_octave >= 4 else 11
+            c_ls = 13 if self.piano_octave <= 0 else 11
+            img.text(234, 244, ">>", c_rs)
+            img.text(8, 244, "<<", c_ls)
+        px.blt(0, 232, self.piano_image, 0, 0, 256, 24)
 
     def play_piano_note(self, key, note, pattern, hold_key=True):
         state = {
@@ -477,6 +621,7 @@ class App:
         }
         result = {}
         sounds.putNotes(960 * 48, state, self.tones, result)
+        result = sounds.join_result(result)
         px.sounds[0].set(
             result["note"],
             result["tone"],
@@ -555,7 +700,8 @@ class App:
         for idx, parm in enumerate(list_parm):
             if not parm is None:
                 px.text(x_base + 32, y_base + idx * 8, str(tone[parm]), 7)
-        # ADSRグラフ
+        # ADSRグラフ（コンパイルと同じエンベロープ表から描画する）
+        envelope = sounds.get_envelope(tone, None, 7)
         attack = tone["attack"]
         decay = tone["decay"]
         sustain = tone["sustain"] / 100
@@ -569,10 +715,9 @@ class App:
             px.line(x, 96, x, 160, 9)
             px.text(x, 162, "vib >>", 9)
         if scale > 60 or sustain > 0:
-            draw_adsr(0, attack, 0, 1, scale, 7)
-            draw_adsr(attack, decay, 1, sustain, scale, 7)
-            draw_adsr(attack + decay, len_sus, sustain, sustain, scale, 11, "sus")
-            draw_adsr(attack + decay + len_sus, release, sustain, 0, scale, 3)
+            draw_adsr(envelope, False, 0, 0, attack + decay, scale, 7)
+            draw_adsr(envelope, False, 0, attack + decay, len_sus, scale, 11, "sus")
+            draw_adsr(envelope, True, attack + decay + len_sus, 0, release, scale, 3)
         # カーソル
         self.draw_cursol(x_base - 4, 22 + self.tone_cursol * 8, 80)
         # 音色名入力ロケータ
@@ -589,6 +734,7 @@ class App:
             tone[key] = max(min(value, 100), 0)
         else:
             tone[key] = value
+        sounds.clear_envelopes()
 
     # ===============================================
     # ノート編集
@@ -615,10 +761,9 @@ class App:
                     for col in range(col1, col2):
                         if row == 0 and col <= 2:
                             continue
-                        self.items[row][col] = None
-                self.set_locs()
+                        self.history.set_cell(self.items, row, col, None)
+                self.set_locs(y1, max_row)
                 self.auto_delete_rows()
-                self.set_locs()
                 # self.add_crow(-1, True)
                 return
             if self.cx1 == 0 and self.crow1 == 0:
@@ -629,7 +774,7 @@ class App:
             while col1 <= col2:
                 if self.crow1 >= len(self.items):
                     break
-                if not is_deleted and not self.items[self.crow1][col1] is None:
+                if not is_deleted and not self.items.get(self.crow1, col1) is None:
                     is_deleted = True
                     self.push_pool()
                 self.set_item(self.crow1, col1, None)
@@ -661,9 +806,8 @@ class App:
         else:
             self.cx2 = self.cx1
             self.crow2 = self.crow1
-        if self.cx1 > 0 and self.piano_tones:
-            tone_row = min(self.crow1, len(self.piano_tones) - 1)
-            self.piano_tone = self.piano_tones[tone_row][self.cx1 - 1]
+        if self.cx1 > 0:
+            self.piano_tone = self.timeline.tones(self.crow1)[self.cx1 - 1]
 
     def draw_notes(self):
         # 再生インジケータ
@@ -676,49 +820,33 @@ class App:
                 self.pos += play_row
                 play_row = self.playing_row - self.pos
             px.rect(0, base_y + (play_row + 1) * 8, 256, 8, 1)
-        # 枠
+        # 表示中の行のうち、前回から変わった行だけをグリッド画像に描き直す
         last_row = min(len(self.items) - self.pos, 25)
-        last_y = base_y + (last_row + 1) * 8 - 1
-        for x in tpl_vline_p:
-            px.line(x, base_y, x, last_y, 5)
-        for x in tpl_vline_s:
-            px.line(x, base_y, x, last_y, 1)
-        # データ
         loc = 0
-        tick = 0
-        saved_item = copy.deepcopy(item_empty)
-        for item_idx in range(len(self.items)):
-            item = self.items[item_idx]
-            for i, data in enumerate(item):
-                if not data is None:
-                    saved_item[i] = item[i]
-            loc_size = saved_item[1]
-            if not saved_item[2] is None:
-                tick += saved_item[2]
-            if tick == loc_size:
-                tick = 0
-            pos = item_idx - self.pos
-            if pos >= 0 and pos < 25:
-                y = base_y + 9 + 8 * pos
-                c = 9
-                if loc != self.locs[item_idx]:
-                    loc = self.locs[item_idx]
-                    c = 10
+        for pos in range(25):
+            if pos >= last_row:
+                key = None
+            else:
+                item_idx = self.pos + pos
+                c_loc = 9
+                if loc != self.timeline.loc(item_idx):
+                    loc = self.timeline.loc(item_idx)
+                    c_loc = 10
                 s = "<<" if item_idx == self.playing_start else str(loc)
-                px.text(tpl_cx[19] * 4 + 1, y, s, c)
-                for i, data in enumerate(item):
-                    if pos == 0:
-                        self.draw_item(y, i, saved_item[i], not data is None)
-                    else:
-                        self.draw_item(y, i, data, True)
+                item = self.items[item_idx]
+                saved_item = self.timeline.item(item_idx) if pos == 0 else None
+                (loc_size, tick) = self.timeline.beat(item_idx)
                 beat_size = dict_beat[loc_size]
-                c = 1
+                c_beat = 1
                 if tick == 0:
-                    c = 10
+                    c_beat = 10
                 elif tick % (loc_size // beat_size) == 0:
-                    c = 5
-                y = base_y + 7 + pos * 8 + 8
-                px.line(0, y, 255, y, c)
+                    c_beat = 5
+                key = (s, c_loc, tuple(item), saved_item, c_beat)
+            if key != self.grid_keys[pos]:
+                self.grid_keys[pos] = key
+                self.draw_row(pos, key)
+        px.blt(0, base_y, self.grid_image, 0, 0, 256, 208, 0)
         # カーソル
         if not self.is_playing:
             (x1, x2, y1, y2) = self.get_x12y12()
@@ -733,6 +861,27 @@ class App:
         px.text(53, base_y + 1, "@1 V Qu Nte @2 V Qu Nte @3 V Qu Nte @4 V Qu Nte", 6)
         px.text(245, base_y + 1, "Loc", 10)
 
+    def draw_row(self, pos, key):
+        img = self.grid_image
+        y = 8 + 8 * pos
+        img.rect(0, y, 256, 8, 0)
+        if key is None:
+            return
+        (s, c_loc, item, saved_item, c_beat) = key
+        # 枠
+        for x in tpl_vline_p:
+            img.line(x, y, x, y + 7, 5)
+        for x in tpl_vline_s:
+            img.line(x, y, x, y + 7, 1)
+        # データ
+        img.text(tpl_cx[19] * 4 + 1, y + 1, s, c_loc)
+        for i, data in enumerate(item):
+            if saved_item is None:
+                self.draw_item(img, y + 1, i, data, True)
+            else:
+                self.draw_item(img, y + 1, i, saved_item[i], not data is None)
+        img.line(0, y + 7, 255, y + 7, c_beat)
+
     # ===============================================
     # パラメータ編集
     # ===============================================
@@ -747,7 +896,7 @@ class App:
         self.params_y = y + 10
         if self.params_y + self.params_height >= 254:
             self.params_y = y - 4 - self.params_height
-        self.params_saved = repr(self.items)
+        self.params_saved = self.timeline.revision
         self.push_pool()
         self.params_cursol = 1 if self.cx1 > 0 else 2
         self.numstock = 0
@@ -760,8 +909,11 @@ class App:
 
     def edit_params(self):
         if px.btnp(px.KEY_RETURN) or px.btnp(px.KEY_AT) or px.btnp(px.KEY_ESCAPE):
-            if repr(self.items) == self.params_saved:
-                self.pool.pop(len(self.pool) - 1)
+            if (
+                self.timeline.revision == self.params_saved
+                or not self.history.is_changed()
+            ):
+                self.history.cancel()
             self.close_params()
         if px.btnp(px.KEY_TAB):
             self.numstock = 0
@@ -847,7 +999,9 @@ class App:
         return get_col(self.cx1) + self.params_cursol
 
     def is_col_first(self):
-        return self.crow1 == 0 or self.locs[self.crow1] > self.locs[self.crow1 - 1]
+        if self.crow1 == 0:
+            return True
+        return self.timeline.loc(self.crow1) > self.timeline.loc(self.crow1 - 1)
 
     # ===============================================
     # confirmウィンドウ
@@ -926,60 +1080,24 @@ class App:
 
     def get_next_loc(self, row):
         dist_row = row
-        self.set_locs()
-        loc = self.locs[row]
-        while self.locs[dist_row + 1] == loc:
+        loc = self.timeline.loc(row)
+        while self.timeline.loc(dist_row + 1) == loc:
             dist_row += 1
         return dist_row
 
     def get_prev_loc(self, row):
         dist_row = row
-        loc = self.locs[row]
-        while dist_row > 0 and self.locs[dist_row - 1] == loc:
+        loc = self.timeline.loc(max(row, 0))
+        while dist_row > 0 and self.timeline.loc(dist_row - 1) == loc:
             dist_row -= 1
         return dist_row
 
-    def set_locs(self):
-        speed = 0
-        loc = 1
-        tick = 0
-        tick_total = 0
-        loc_size = 0
-        tick_size = 0
-        idx = 0
-        locs = []
-        items_tick = []
-        piano_tones = []
-        current_tones = [0, 0, 0, 0]
-        while True:
-            item = self.get_item(idx)
-            items_tick.append(tick_total)
-            locs.append(loc)
-            current_tones = current_tones.copy()
-            if not item[0] is None:
-                speed = item[0]
-            if not item[1] is None:
-                loc_size = item[1]
-            if not item[2] is None:
-                tick_size = item[2]
-            for ch in range(4):
-                tone = item[3 + ch * 4]
-                if not tone is None:
-                    current_tones[ch] = tone
-            piano_tones.append(current_tones)
-            tick += tick_size
-            tick_total += speed * tick_size
-            if tick >= loc_size:
-                tick -= loc_size
-                loc += 1
-                if len(self.items) <= idx:
-                    locs.append(loc)
-                    break
-            idx += 1
-        items_tick.append(tick_total)
-        self.piano_tones = piano_tones
-        self.items_tick = items_tick
-        self.locs = locs
+    # 行番号を指定すると、その範囲が変わったものとして差分だけ更新する
+    def set_locs(self, row=None, last_row=None):
+        if row is None:
+            self.timeline = timeline.Timeline(self.items)
+        else:
+            self.timeline.update(row, last_row)
 
     def init_items(self):
         items = []
@@ -988,11 +1106,12 @@ class App:
         items[0][1] = 48
         items[0][2] = 6
         self.project = ""
-        self.items = items
+        self.project_ext = self.default_project_ext
+        self.items = self.history.replace(self.items, song.Song(items))
         self.crow1 = 0
         self.pos = 0
-        self.set_item(0, 3, None)
         self.set_locs()
+        self.set_item(0, 3, None)
 
     def get_item(self, row):
         return self.items[row] if row < len(self.items) else copy.deepcopy(item_empty)
@@ -1002,38 +1121,32 @@ class App:
             return
         self.message = None
         self.auto_add_rows(row, recalc)
-        self.items[row][col] = data
-        if recalc:
-            self.set_locs()
+        if self.history.set_cell(self.items, row, col, data) and recalc:
+            self.set_locs(row)
 
     def auto_add_rows(self, row, recalc=True):
         if recalc:
             dist_row = self.get_next_loc(row)
         else:
             dist_row = row
-        while dist_row > len(self.items) - 1:
-            self.items.append(copy.deepcopy(item_empty))
+        size = len(self.items)
+        if dist_row >= size:
+            rows = [copy.deepcopy(item_empty) for _ in range(dist_row - size + 1)]
+            self.history.insert_rows(self.items, size, rows)
+            self.set_locs(size)
 
     def auto_delete_rows(self):
         if not self.params_cx is None:
             return
-        loop = True
-        while loop:
+        # 末尾の小節が空なら小節ごと削除する
+        while True:
             loc = self.get_prev_loc(len(self.items) - 1)
             next_loc = self.get_next_loc(loc) + 1
-            locs = next_loc - loc
-            while loc < next_loc:
-                for data in self.get_item(loc):
-                    if not data is None:
-                        loop = False
-                        break
-                else:
-                    loc += 1
-                    continue
-                loop = False
+            if self.timeline.count(loc, next_loc) > 0:
                 break
-            else:
-                del self.items[-locs:]
+            size = next_loc - loc
+            self.history.delete_rows(self.items, len(self.items) - size, size)
+            self.set_locs(len(self.items))
         self.fix_cursor_row()
 
     def fix_cursor_row(self):
@@ -1043,7 +1156,7 @@ class App:
         if self.pos > self.crow1:
             self.pos = self.crow1
 
-    def draw_item(self, y, i, data, is_real):
+    def draw_item(self, img, y, i, data, is_real):
         if not data is None:
             x = tpl_cx[i] * 4 + 1
             if i == 0:
@@ -1065,7 +1178,7 @@ class App:
                 c = 11 if is_real else 3
             else:
                 c = 6 if is_real else 12
-            px.text(x, y, txt, c)
+            img.text(x, y, txt, c)
 
     def set_note(self, channel, note):
         if channel >= 0:
@@ -1108,14 +1221,20 @@ def draw_window(x, y, width, height):
     px.rectb(x, y, width, height, 7)
 
 
-def draw_adsr(start, length, v1, v2, scale, col, txt=None):
-    x1 = start * 120 / scale + 104
-    y1 = 160 - v1 * 64
-    x2 = (start + length) * 120 / scale + 104
-    y2 = 160 - v2 * 64
-    px.line(x1, y1, x2, y2, col)
-    if txt and v1 > 0:
-        px.text((x1 + x2) / 2 - 6, y1 - 6, txt, col)
+def draw_adsr(envelope, is_rest, start, duration, length, scale, col, txt=None):
+    step = max(scale // 120, 1)
+    x1 = (start + duration) * 120 / scale + 104
+    y1 = 160 - sounds.get_level(envelope, duration, is_rest) * 64
+    x_start, y_start = x1, y1
+    end = duration + length
+    while duration < end:
+        duration = min(duration + step, end)
+        x2 = (start + duration) * 120 / scale + 104
+        y2 = 160 - sounds.get_level(envelope, duration, is_rest) * 64
+        px.line(x1, y1, x2, y2, col)
+        x1, y1 = x2, y2
+    if txt and y_start < 160:
+        px.text((x_start + x1) / 2 - 6, y_start - 6, txt, col)
 
 
 dict_input = {
@@ -1190,6 +1309,8 @@ list_tick = [12, 8, 6, 4, 3, 2, 1]
 list_wave = ["P", "S", "T", "N"]
 list_parm = [None, "wave", "attack", "decay", "sustain", "release", "vibrato"]
 base_y = 0
+# ファイル選択画面に表示する行数
+files_rows = 27
 tpl_vline_p = (50, 98, 146, 194, 242)
 tpl_vline_s = (14, 30, 62, 70, 82, 110, 118, 130, 158, 166, 178, 206, 214, 226)
 tpl_cx = (0, 4, 8, 13, 16, 18, 21, 25, 28, 30, 33, 37, 40, 42, 45, 49, 52, 54, 57, 61)
@@ -1,5 +1,6 @@
 import pyxel
 import json
+import re
 
 MUSIC_FILE = "sample"
 
@@ -8,7 +9,7 @@ class App:
     def __init__(self):
         pyxel.init(160, 120, title="Pyxel Tracker Player")
         with open(f"./musics/{MUSIC_FILE}.json", "rt") as fin:
-            self.music = json.loads(fin.read())
+            self.music = expand(json.loads(fin.read()))
         pyxel.run(self.update, self.draw)
 
     def update(self):
@@ -28,4 +29,25 @@ class App:
         pyxel.text(20, 64, "Press [ESC] to exit.", 7)
 
 
-App()
+# 圧縮形式（"c#2{12}"のようなランレングス）の再生データを展開する
+def expand(music):
+    if not isinstance(music, dict):
+        return music
+    sounds = []
+    for sound in music["sounds"]:
+        if sound is None:
+            sounds.append(None)
+            continue
+        sounds.append([decode_rle(s) for s in sound[0:4]] + [sound[4]])
+    return sounds
+
+
+def decode_rle(s):
+    parts = re.split(r"(r|[a-g]#?\d|[^{}])\{(\d+)\}", s)
+    parts[1::3] = [token * int(count) for token, count in zip(parts[1::3], parts[2::3])]
+    del parts[2::3]
+    return "".join(parts)
+
+
+if __name__ == "__main__":
+    App()
@@ -0,0 +1,166 @@
+# 変更されたセルと行だけを記録するアンドゥ・リドゥ履歴（items: song.Song）
+import collections
+
+# 保持する変更量の上限（セル数換算）
+MAX_CELLS = 1000000
+
+
+class History:
+    def __init__(self, max_cells=MAX_CELLS):
+        self.max_cells = max_cells
+        self.undos = collections.deque()
+        # (変更, その状態から次のリドゥまでに記録された変更) のリスト
+        self.redos = []
+        self.cells = 0
+        # アンドゥ・リドゥの後に記録された変更（次のリドゥの前に取り消す）
+        self.pending = []
+
+    def clear(self):
+        self.undos.clear()
+        self.redos = []
+        self.cells = 0
+        self.pending = []
+
+    # 編集の区切り（この時点の状態にアンドゥで戻る）
+    def begin(self):
+        self.undos.append([])
+        self.redos = []
+        self.pending = []
+        while self.cells > self.max_cells and len(self.undos) > 1:
+            self.cells -= count_cells(self.undos.popleft())
+
+    # 直前の区切りを取り消す（変更がなかったとき）
+    def cancel(self):
+        if self.undos:
+            self.cells -= count_cells(self.undos.pop())
+
+    # 直前の区切りからの変更が元に戻っていないか（同じセルを変えて戻しただけならFalse）
+    def is_changed(self):
+        if not self.undos:
+            return False
+        cells = {}
+        for op in self.undos[-1]:
+            if op[0] != "set":
+                return True
+            (_, row, col, old, value) = op
+            first = cells.setdefault((row, col), old)
+            if first == value:
+                del cells[(row, col)]
+        return len(cells) > 0
+
+    def record(self, op):
+        if self.redos:
+            self.pending.append(op)
+        if self.undos:
+            self.undos[-1].append(op)
+            self.cells += count_cells([op])
+
+    def set_cell(self, items, row, col, value):
+        old = items.get(row, col)
+        if old == value:
+            return False
+        items.set(row, col, value)
+        self.record(("set", row, col, old, value))
+        return True
+
+    def insert_rows(self, items, row, rows):
+        items.insert(row, rows)
+        self.record(("insert", row, rows))
+
+    def delete_rows(self, items, row, count):
+        rows = items.delete(row, count)
+        self.record(("delete", row, rows))
+
+    def replace(self, items, new_items):
+        self.record(("replace", items, new_items))
+        return new_items
+
+    # (items, 変更された最初の行, 最後の行) を返す。行がNoneなら全体が変わった
+    def undo(self, items):
+        if not self.undos:
+            return None
+        ops = self.undos.pop()
+        self.cells -= count_cells(ops)
+        # アンドゥ後の変更はopsの末尾にも入っているので、リドゥするとその状態に戻る
+        self.redos.append((ops, self.pending))
+        self.pending = []
+        rows = Range()
+        items = revert(items, ops, rows)
+        return rows.result(items)
+
+    def redo(self, items):
+        if not self.redos:
+            return None
+        # アンドゥ後の変更は取り消してから進める（次のアンドゥでその状態に戻る）
+        (redo_ops, pending) = self.redos.pop()
+        ops = [invert(op) for op in reversed(self.pending)] + redo_ops
+        self.pending = list(pending)
+        self.undos.append(ops)
+        self.cells += count_cells(ops)
+        rows = Range()
+        items = apply(items, ops, rows)
+        return rows.result(items)
+
+
+def apply(items, ops, rows):
+    for op in ops:
+        if op[0] == "set":
+            (_, row, col, _, value) = op
+            items.set(row, col, value)
+            rows.add(row, row)
+        elif op[0] == "insert":
+            items.insert(op[1], op[2])
+            rows.add(op[1], len(items) - 1)
+        elif op[0] == "delete":
+            items.delete(op[1], len(op[2]))
+            rows.add(op[1], len(items) - 1)
+        else:
+            items = op[2]
+            rows.is_all = True
+    return items
+
+
+def revert(items, ops, rows):
+    return apply(items, [invert(op) for op in reversed(ops)], rows)
+
+
+def invert(op):
+    if op[0] == "set":
+        return ("set", op[1], op[2], op[4], op[3])
+    if op[0] == "insert":
+        return ("delete", op[1], op[2])
+    if op[0] == "delete":
+        return ("insert", op[1], op[2])
+    return ("replace", op[2], op[1])
+
+
+# 変更された行の範囲
+class Range:
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.is_all = False
+
+    def add(self, first, last):
+        last = max(first, last)
+        self.first = first if self.first is None else min(self.first, first)
+        self.last = last if self.last is None else max(self.last, last)
+
+    def result(self, items):
+        if self.is_all:
+            return (items, None, None)
+        if self.first is None:
+            return (items, 0, -1)
+        return (items, self.first, self.last)
+
+
+def count_cells(ops):
+    cells = 0
+    for op in ops:
+        if op[0] == "set":
+            cells += 1
+        elif op[0] == "replace":
+            cells += len(op[1]) * 19
+        else:
+            cells += len(op[2]) * 19
+    return cells
@@ -0,0 +1,96 @@
+# プロジェクトファイルの読み書き（json形式とバイナリ形式）
+#
+# バイナリ形式: MAGIC + バージョン(1バイト) + 以下をzlibで圧縮したもの
+#   行数(4バイト) + キーの数(2バイト) + キー(長さ1バイト + utf-8)の並び
+#   + 19列それぞれについて 型(1文字) + バイト数(4バイト) + リトルエンディアンの配列
+import array
+import json
+import os
+import struct
+import sys
+import zlib
+
+from system import song
+
+MAGIC = b"PXTR"
+VERSION = 1
+JSON_EXT = ".json"
+BINARY_EXT = ".pxtr"
+EXTENSIONS = (JSON_EXT, BINARY_EXT)
+
+
+def is_binary(path):
+    return path.endswith(BINARY_EXT)
+
+
+def load(path):
+    with open(path, "rb") as fin:
+        data = fin.read()
+    if is_binary(path):
+        return loads_binary(data)
+    return song.Song(json.loads(data.decode("utf-8")))
+
+
+# 保存する内容（パスの拡張子で形式を決める）
+def dumps(items, path):
+    if is_binary(path):
+        return dumps_binary(items)
+    return json.dumps(items.to_items())
+
+
+def dumps_binary(items):
+    body = [struct.pack("<IH", len(items), len(items.keys))]
+    for key in items.keys:
+        key = key.encode("utf-8")
+        body.append(struct.pack("<B", len(key)) + key)
+    for values in items.cols:
+        if sys.byteorder == "big":
+            values = array.array(values.typecode, values)
+            values.byteswap()
+        data = values.tobytes()
+        body.append(struct.pack("<cI", values.typecode.encode(), len(data)) + data)
+    return MAGIC + struct.pack("<B", VERSION) + zlib.compress(b"".join(body))
+
+
+def loads_binary(data):
+    if data[0:4] != MAGIC:
+        raise ValueError("Not a project file")
+    if data[4] != VERSION:
+        raise ValueError(f"Unsupported project file version: {data[4]}")
+    body = zlib.decompress(data[5:])
+    (rows, key_count) = struct.unpack_from("<IH", body)
+    offset = 6
+    items = song.Song()
+    for _ in range(key_count):
+        size = body[offset]
+        items.keys.append(body[offset + 1 : offset + 1 + size].decode("utf-8"))
+        offset += 1 + size
+    for col in range(19):
+        (typecode, size) = struct.unpack_from("<cI", body, offset)
+        offset += 5
+        values = array.array(typecode.decode())
+        values.frombytes(body[offset : offset + size])
+        if sys.byteorder == "big":
+            values.byteswap()
+        if len(values) != rows:
+            raise ValueError("Broken project file")
+        items.cols[col] = values
+        offset += size
+    return items
+
+
+# 拡張子を付けたプロジェクトファイルのパス（どちらもなければdefault_extで作る）
+def find_path(dirname, project, default_ext=JSON_EXT):
+    for ext in (default_ext,) + EXTENSIONS:
+        path = os.path.join(dirname, project + ext)
+        if os.path.exists(path):
+            return path
+    return os.path.join(dirname, project + default_ext)
+
+
+def convert(src_path, dst_path):
+    data = dumps(load(src_path), dst_path)
+    mode = "wb" if is_binary(dst_path) else "wt"
+    encoding = None if is_binary(dst_path) else "utf-8"
+    with open(dst_path, mode, encoding=encoding) as fout:
+        fout.write(data)
@@ -0,0 +1,72 @@
+# ファイル選択画面用に、プロジェクトごとの情報（小節数・長さ・BPM・サイズ）をキャッシュする
+import json
+import os
+
+from system import project_file
+from system import timeline
+
+INDEX_PATH = "./user/project_index.json"
+# 通算tickを秒に直す（1/48が再生時のtick、1秒は120tick）
+TICKS_PER_SECOND = 48 * 120
+
+
+def load(path=INDEX_PATH):
+    try:
+        with open(path, "rt", encoding="utf-8") as fin:
+            return json.loads(fin.read())
+    except:
+        return {}
+
+
+# 更新日時かサイズが変わったファイルだけ読み直す。索引が変わったらTrueを返す
+def update(index, dirname):
+    is_changed = False
+    paths = set()
+    with os.scandir(dirname) as entries:
+        for entry in entries:
+            if not entry.name.endswith(project_file.EXTENSIONS):
+                continue
+            path = f"{dirname}/{entry.name}"
+            paths.add(path)
+            stat = entry.stat()
+            info = index.get(path)
+            if (
+                info
+                and info["mtime"] == stat.st_mtime_ns
+                and info["size"] == stat.st_size
+            ):
+                continue
+            info = {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+            try:
+                info.update(get_info(project_file.load(path)))
+            except Exception:
+                info.update({"bars": None, "seconds": None, "bpm": None})
+            index[path] = info
+            is_changed = True
+    for path in list(index):
+        if not path in paths:
+            del index[path]
+            is_changed = True
+    return is_changed
+
+
+def get_info(items):
+    if len(items) == 0:
+        return {"bars": 0, "seconds": 0, "bpm": None}
+    tl = timeline.Timeline(items)
+    speed = items.get(0, 0)
+    return {
+        "bars": tl.loc(len(items) - 1),
+        "seconds": tl.tick(len(items)) / TICKS_PER_SECOND,
+        "bpm": 28800 // speed if speed else None,
+    }
+
+
+# ファイル選択画面の1行表示
+def get_text(info):
+    if info is None or info["bars"] is None:
+        return "(broken file)"
+    (minutes, seconds) = divmod(int(info["seconds"]), 60)
+    bpm = "-" if info["bpm"] is None else info["bpm"]
+    size = info["size"] / 1024
+    return f"{info['bars']} bars  {minutes}:{seconds:02}  BPM {bpm}  {size:.1f}KB"
@@ -0,0 +1,101 @@
+# ファイルをバックグラウンドで書き出す（一時ファイルに書いてから置き換える）
+import atexit
+import hashlib
+import os
+import tempfile
+import threading
+
+
+class Saver:
+    def __init__(self):
+        self.cond = threading.Condition()
+        # 書き出し待ちの {パス: 内容を作る関数}（同じパスは最後の1回だけ書く）
+        self.pending = {}
+        self.is_writing = False
+        # 最後に書いた（または読んだ）内容のハッシュ
+        self.hashes = {}
+        self.error = None
+        self.thread = None
+        # mkstempのファイルは0600になるので、open()と同じ権限に直す
+        # （umaskは書き換えないと読めないので、スレッドを作る前に読んでおく）
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = 0o666 & ~umask
+        atexit.register(self.flush)
+
+    # make_dataは書き出しスレッドで呼ばれ、strかbytesを返す
+    def save(self, path, make_data):
+        with self.cond:
+            self.pending[path] = make_data
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    # 書き出し待ちがなくなるまで待つ
+    def flush(self):
+        with self.cond:
+            while self.pending or self.is_writing:
+                self.cond.wait()
+
+    # 書き出しに失敗していたらそのエラーを返す（一度だけ）
+    def pop_error(self):
+        with self.cond:
+            error = self.error
+            self.error = None
+            return error
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                path = next(iter(self.pending))
+                make_data = self.pending.pop(path)
+                self.is_writing = True
+            try:
+                self.write(path, make_data())
+            except Exception as err:
+                with self.cond:
+                    self.error = err
+            with self.cond:
+                self.is_writing = False
+                self.cond.notify_all()
+
+    def write(self, path, data):
+        if type(data) is str:
+            data = data.encode("utf-8")
+        digest = hashlib.sha1(data).digest()
+        if not path in self.hashes:
+            self.hashes[path] = get_hash(path)
+        if self.hashes[path] == digest:
+            return
+        dirname = os.path.dirname(path)
+        (fd, tmp_path) = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            os.chmod(tmp_path, get_mode(path, self.mode))
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(data)
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.replace(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        self.hashes[path] = digest
+
+
+def get_hash(path):
+    try:
+        with open(path, "rb") as fin:
+            return hashlib.sha1(fin.read()).digest()
+    except OSError:
+        return None
+
+
+# 既存のファイルがあればその権限を引き継ぐ
+def get_mode(path, default):
+    try:
+        return os.stat(path).st_mode & 0o777
+    except OSError:
+        return default
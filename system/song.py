@@ -0,0 +1,94 @@
+# 曲データ（19列の行）を列ごとの配列で持つモデル
+import array
+
+UNSET = -128
+# 0列目（speed）だけ2バイト、他は1バイト
+TYPECODES = "h" + "b" * 18
+# KEY_BASE以下の値はドラムパターンのキーの表引き（キーは":0"〜":9"）
+KEY_BASE = -100
+
+
+class Song:
+    def __init__(self, items=()):
+        self.cols = [array.array(code) for code in TYPECODES]
+        # ドラムパターンのキー（":1"など）
+        self.keys = []
+        self.insert(0, items)
+
+    def __len__(self):
+        return len(self.cols[0])
+
+    def __getitem__(self, row):
+        if type(row) is slice:
+            return [self[idx] for idx in range(*row.indices(len(self)))]
+        return [self.get(row, col) for col in range(19)]
+
+    def __iter__(self):
+        return iter(self.to_items())
+
+    # 保存用の複製（配列ごとコピーするので速い）
+    def copy(self):
+        song = Song()
+        song.cols = [array.array(values.typecode, values) for values in self.cols]
+        song.keys = list(self.keys)
+        return song
+
+    def encode(self, value):
+        if value is None:
+            return UNSET
+        if type(value) is str:
+            if not value in self.keys:
+                self.keys.append(value)
+            return KEY_BASE - self.keys.index(value)
+        return value
+
+    def decode(self, value):
+        if value == UNSET:
+            return None
+        if value <= KEY_BASE:
+            return self.keys[KEY_BASE - value]
+        return value
+
+    def get(self, row, col):
+        return self.decode(self.cols[col][row])
+
+    def set(self, row, col, value):
+        value = self.encode(value)
+        try:
+            self.cols[col][row] = value
+        except OverflowError:
+            self.widen(col)
+            self.cols[col][row] = value
+
+    def insert(self, row, items):
+        for col, values in enumerate(zip(*items)):
+            encoded = [self.encode(value) for value in values]
+            try:
+                values = array.array(self.cols[col].typecode, encoded)
+            except OverflowError:
+                self.widen(col)
+                values = array.array(self.cols[col].typecode, encoded)
+            self.cols[col][row:row] = values
+
+    # 範囲外の値（ヘッダの値をチャンネル列に貼り付けたときなど）が入ったら列を広げる
+    def widen(self, col):
+        self.cols[col] = array.array("q", self.cols[col])
+
+    # 削除した行を返す
+    def delete(self, row, count):
+        items = self[row : row + count]
+        for values in self.cols:
+            del values[row : row + count]
+        return items
+
+    # 行の入力済みセル数
+    def count(self, row):
+        return sum(1 for values in self.cols if values[row] != UNSET)
+
+    # sounds.compile・make_midi・JSON保存用のリスト形式
+    def to_items(self):
+        codes = {KEY_BASE - idx: key for idx, key in enumerate(self.keys)}
+        codes[UNSET] = None
+        get = codes.get
+        cols = [[get(value, value) for value in values] for values in self.cols]
+        return [list(item) for item in zip(*cols)]
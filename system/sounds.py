@@ -1,5 +1,10 @@
+import re
 import sys
 import math
+import copy
+import bisect
+import functools
+import concurrent.futures
 
 try:
     import mido
@@ -7,25 +12,31 @@ try:
 except:
     pass
 
+try:
+    import numpy as np
+except:
+    np = None
+
 list_notes = ("c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b")
 
+# 分割コンパイルの1区切りのtick数（10秒）
+CHUNK_TICKS = 1200
+
 
+# resultの各項目には1tickごとの文字列をリストで追加していく（結合は呼び出し側で行う）
 def putNotes(note_len, state, tones, result):
     if len(result.keys()) == 0:
-        result["note"] = ""
-        result["tone"] = ""
-        result["volume"] = ""
-        result["effect"] = ""
-    tone = tones[state["tone"]]
-    pattern = state["pattern"]
-    decay = pattern["decay"] if pattern and "decay" in pattern else tone["decay"]
-    sustain = (
-        pattern["sustain"] if pattern and "sustain" in pattern else tone["sustain"]
-    )
-    velocity = pattern["velocity"] / 100 if pattern else 1.0
+        result["note"] = []
+        result["tone"] = []
+        result["volume"] = []
+        result["effect"] = []
+    envelope = get_envelope(tones[state["tone"]], state["pattern"], state["volume"])
+    pattern_notes = envelope["pattern_notes"]
+    limit = envelope["limit"]
+    release = envelope["release"]
+    wave = envelope["wave"]
     loops = int((note_len + state["tick"]) / 48) - int(state["tick"] / 48)
     for _ in range(loops):
-        level = 0
         state["duration"] += 1
         duration = state["duration"]
         if (
@@ -35,61 +46,142 @@ def putNotes(note_len, state, tones, result):
             state["is_rest"] = True
             state["duration"] = 0
             duration = 1
+        idx = duration if duration <= limit else limit - (duration - limit) % 2
         if state["is_rest"]:
-            release = tone["release"] if "release" in tone else 0
-            if duration < release:
-                level = sustain / 100 * (1 - duration / release)
-            else:
-                level = 0
+            volume = envelope["volumes_off"][idx]
+            if duration >= release:
                 state["note"] = -1
         else:
-            if duration < tone["attack"]:
-                level = duration / tone["attack"]
-            elif duration < tone["attack"] + decay:
-                level = 1 - (1 - sustain / 100) * ((duration - tone["attack"]) / decay)
-            else:
-                level = sustain / 100
-        if pattern:
-            notes = pattern["notes"]
-            note = notes[min(duration, len(notes)) - 1]
-            state["note"] = note
-            note_str = list_notes[note % 12] + str(note // 12)
+            volume = envelope["volumes_on"][idx]
+        if pattern_notes:
+            state["note"] = pattern_notes[idx]
+            note_str = envelope["note_strs"][idx]
         elif state["note"] is None or state["note"] < 0:
             note_str = "r"
         else:
             note = state["note"]
             note_str = list_notes[note % 12] + str(note // 12)
-        skipVib = tone["wave"] in ["S", "T"] and duration % 2 != 0
-        vibrato = tone["vibrato"] if "vibrato" in tone else 0
+        result["note"].append(note_str)
+        result["tone"].append(wave)
+        result["volume"].append(volume)
+        result["effect"].append(envelope["effects"][idx])
+
+
+# エンベロープ表の取得（音色・パターン・音量が同じなら同じ表を使い回す）
+def get_envelope(tone, pattern, volume):
+    decay = pattern["decay"] if pattern and "decay" in pattern else tone["decay"]
+    sustain = (
+        pattern["sustain"] if pattern and "sustain" in pattern else tone["sustain"]
+    )
+    return make_envelope(
+        tone["wave"],
+        tone["attack"],
+        decay,
+        sustain,
+        tone["release"] if "release" in tone else 0,
+        tone["vibrato"] if "vibrato" in tone else 0,
+        volume,
+        pattern["wave"] if pattern else None,
+        tuple(pattern["notes"]) if pattern else None,
+        pattern["velocity"] / 100 if pattern else 1.0,
+    )
+
+
+# 経過tickごとのレベル・音量・エフェクト・パターンのノートを計算した表
+# limitより後はレベルとノートが一定で、エフェクトは偶奇のみで決まる
+@functools.lru_cache(maxsize=1024)
+def make_envelope(
+    wave,
+    attack,
+    decay,
+    sustain,
+    release,
+    vibrato,
+    volume,
+    pattern_wave,
+    notes,
+    velocity,
+):
+    limit = max(attack + decay, release, vibrato, len(notes) if notes else 0) + 2
+    levels_on = []
+    levels_off = []
+    effects = []
+    for duration in range(limit + 1):
+        if duration < attack:
+            level = duration / attack
+        elif duration < attack + decay:
+            level = 1 - (1 - sustain / 100) * ((duration - attack) / decay)
+        else:
+            level = sustain / 100
+        levels_on.append(level)
+        if duration < release:
+            level = sustain / 100 * (1 - duration / release)
+        else:
+            level = 0
+        levels_off.append(level)
+        skipVib = wave in ["S", "T"] and duration % 2 != 0
         effect = "n" if vibrato == 0 or duration < vibrato or skipVib else "v"
-        volume = min(math.ceil(level * state["volume"] * velocity), 7)
-        result["note"] += note_str
-        result["tone"] += pattern["wave"] if pattern else tone["wave"]
-        result["volume"] += str(volume)
-        result["effect"] += effect
+        effects.append(effect)
+    pattern_notes = None
+    note_strs = None
+    if notes:
+        pattern_notes = [
+            notes[min(duration, len(notes)) - 1] for duration in range(limit + 1)
+        ]
+        note_strs = [list_notes[note % 12] + str(note // 12) for note in pattern_notes]
+    return {
+        "limit": limit,
+        "release": release,
+        "wave": pattern_wave or wave,
+        "levels_on": levels_on,
+        "levels_off": levels_off,
+        "volumes_on": [get_volume(level, volume, velocity) for level in levels_on],
+        "volumes_off": [get_volume(level, volume, velocity) for level in levels_off],
+        "effects": effects,
+        "pattern_notes": pattern_notes,
+        "note_strs": note_strs,
+    }
 
 
-# Pyxel再生データの生成
-def compile(src, tones, patterns):
+def get_volume(level, volume, velocity):
+    return str(min(math.ceil(level * volume * velocity), 7))
+
+
+def get_level(envelope, duration, is_rest):
+    limit = envelope["limit"]
+    idx = duration if duration <= limit else limit - (duration - limit) % 2
+    return envelope["levels_off" if is_rest else "levels_on"][idx]
+
+
+def clear_envelopes():
+    make_envelope.cache_clear()
+
+
+def new_state():
+    return {
+        "note_cnt": 0,
+        "tone": 0,
+        "volume": 7,
+        "quantize": 1.0,
+        "duration": 0,
+        "note": -1,
+        "is_rest": True,
+        "pattern": None,
+        "tick": 0,
+    }
+
+
+# 行ごとの音長・開始tickと、小節の開始行を求める
+def make_timeline(src):
     speed = 240
     note_len = 48
-    states = []
-    results = []
-    for _ in range(4):
-        states.append(
-            {
-                "note_cnt": 0,
-                "tone": 0,
-                "volume": 7,
-                "quantize": 1.0,
-                "duration": 0,
-                "note": -1,
-                "is_rest": True,
-                "pattern": None,
-                "tick": 0,
-            }
-        )
-        results.append({})
+    tick = 0
+    loc_size = 0
+    tick_size = 0
+    loc_tick = 0
+    note_lens = []
+    ticks = []
+    bars = [0]
     for row, item in enumerate(src):
         if not item[0] is None:
             old_speed = speed
@@ -97,54 +189,505 @@ def compile(src, tones, patterns):
             note_len = note_len / old_speed * speed
         if not item[2] is None:
             note_len = speed * item[2]
-        for ch in range(4):
-            state = states[ch]
-            item_idx = 3 + ch * 4
-            if not item[item_idx] is None:
-                state["tone"] = item[item_idx]
-            if not item[item_idx + 1] is None:
-                state["volume"] = item[item_idx + 1]
-            if not item[item_idx + 2] is None:
-                state["quantize"] = item[item_idx + 2] / 16
-            note = item[item_idx + 3]
-            if not note is None:
-                state["pattern"] = None
-                for pattern in patterns:
-                    if pattern["key"] == note:
-                        state["pattern"] = pattern
-                state["duration"] = 0
-                if note == -1:
-                    state["is_rest"] = True
-                else:
-                    state["is_rest"] = False
-                    state["note"] = note if state["pattern"] is None else None
-                note_cnt = 0
-                while True:
-                    note_cnt += 1
-                    if row + note_cnt >= len(src):
-                        break
-                    nextItem = src[row + note_cnt]
-                    if not nextItem[item_idx + 3] is None:
-                        break
-                state["note_cnt"] = note_cnt
-            putNotes(note_len, state, tones, results[ch])
-            state["tick"] += note_len
-    sounds = []
-    for ch in range(4):
-        sound = results[ch]
-        if sound["note"]:
-            sounds.append(
-                [
-                    sound["note"],
-                    shorten(sound["tone"]),
-                    shorten(sound["volume"]),
-                    shorten(sound["effect"]),
-                    1,
-                ]
+        note_lens.append(note_len)
+        ticks.append(tick)
+        tick += note_len
+        if not item[1] is None:
+            loc_size = item[1]
+        if not item[2] is None:
+            tick_size = item[2]
+        loc_tick += tick_size
+        if loc_tick >= loc_size:
+            loc_tick -= loc_size
+            if row + 1 < len(src):
+                bars.append(row + 1)
+    return {"note_lens": note_lens, "ticks": ticks, "bars": bars, "tick": tick}
+
+
+# チャンネルごとの行データ（音長・tick・音色・音量・クオンタイズ・ノート・ノート長）
+def make_channel_rows(src, ch, timeline):
+    item_idx = 3 + ch * 4
+    note_lens = timeline["note_lens"]
+    ticks = timeline["ticks"]
+    next_rows = make_next_rows(src, item_idx + 3)
+    rows = []
+    for row, item in enumerate(src):
+        note = item[item_idx + 3]
+        rows.append(
+            (
+                note_lens[row],
+                ticks[row],
+                item[item_idx],
+                item[item_idx + 1],
+                item[item_idx + 2],
+                note,
+                None if note is None else next_rows[row] - row,
             )
+        )
+    return rows
+
+
+# 各行より後で最初にノートが置かれている行（なければ曲の長さ）
+def make_next_rows(src, col):
+    next_rows = [0] * len(src)
+    next_row = len(src)
+    for row in range(len(src) - 1, -1, -1):
+        next_rows[row] = next_row
+        if not src[row][col] is None:
+            next_row = row
+    return next_rows
+
+
+def put_row(row, state, tones, patterns, result):
+    (note_len, _, tone, volume, quantize, note, note_cnt) = row
+    if not tone is None:
+        state["tone"] = tone
+    if not volume is None:
+        state["volume"] = volume
+    if not quantize is None:
+        state["quantize"] = quantize / 16
+    if not note is None:
+        state["pattern"] = None
+        for pattern in patterns:
+            if pattern["key"] == note:
+                state["pattern"] = pattern
+        state["duration"] = 0
+        if note == -1:
+            state["is_rest"] = True
+        else:
+            state["is_rest"] = False
+            state["note"] = note if state["pattern"] is None else None
+        state["note_cnt"] = note_cnt
+    putNotes(note_len, state, tones, result)
+    state["tick"] += note_len
+
+
+# 1チャンネル分のコンパイル
+# cacheに前回の結果があれば、変更のあった行を含む小節から再コンパイルし、
+# 小節の頭で状態が前回と一致したらそれ以降は前回の結果を使い回す
+def compile_channel(rows, bars, tones, patterns, cache=None):
+    new_cache = {}
+    for _ in iter_channel(rows, bars, tones, patterns, cache, new_cache):
+        pass
+    return new_cache
+
+
+# 小節ごとの結果を順にyieldし、最後にnew_cacheへ新しいキャッシュを格納する
+def iter_channel(rows, bars, tones, patterns, cache, new_cache):
+    starts = []
+    states = []
+    results = []
+    state = new_state()
+    first = 0
+    old = None
+    # 空の曲のキャッシュ（小節がない）は使わない
+    if cache and cache["starts"]:
+        old_rows = cache["rows"]
+        dirty = 0
+        max_dirty = min(len(rows), len(old_rows))
+        while dirty < max_dirty and rows[dirty] == old_rows[dirty]:
+            dirty += 1
+        if dirty == len(rows) and dirty == len(old_rows):
+            yield from cache["results"]
+            new_cache.update(cache)
+            return
+        idx = bisect.bisect_right(cache["starts"], dirty) - 1
+        starts = cache["starts"][:idx]
+        states = cache["states"][:idx]
+        results = cache["results"][:idx]
+        yield from results
+        state = dict(cache["states"][idx])
+        first = cache["starts"][idx]
+        same_from = len(rows)
+        if len(rows) == len(old_rows):
+            while same_from > dirty and rows[same_from - 1] == old_rows[same_from - 1]:
+                same_from -= 1
+        old = {
+            "index": {start: idx for idx, start in enumerate(cache["starts"])},
+            "same_from": same_from,
+        }
+    bar_idx = bisect.bisect_right(bars, first)
+    start = first
+    while start < len(rows):
+        end = bars[bar_idx] if bar_idx < len(bars) else len(rows)
+        bar_idx += 1
+        if old and start >= old["same_from"] and start in old["index"]:
+            idx = old["index"][start]
+            if state == cache["states"][idx]:
+                starts += cache["starts"][idx:]
+                states += cache["states"][idx:]
+                results += cache["results"][idx:]
+                yield from cache["results"][idx:]
+                break
+        starts.append(start)
+        states.append(dict(state))
+        result = {}
+        for row in range(start, end):
+            put_row(rows[row], state, tones, patterns, result)
+        results.append(join_result(result))
+        yield results[-1]
+        start = end
+    new_cache.update(rows=rows, starts=starts, states=states, results=results)
+
+
+# Pyxel再生データの生成（差分コンパイル用のキャッシュを保持する）
+# executorにconcurrent.futuresのExecutorを渡すと、チャンネルごとに並列でコンパイルする
+class Compiler:
+    def __init__(self):
+        self.tones = None
+        self.patterns = None
+        self.caches = [None, None, None, None]
+        self.music = None
+        self.revision = None
+
+    # revisionを渡すと、前回と同じならコンパイルせずに前回の結果を返す
+    def compile(self, src, tones, patterns, executor=None, revision=None):
+        self.set_tones(tones, patterns)
+        if not revision is None and revision == self.revision:
+            return self.music
+        timeline = make_timeline(src)
+        jobs = []
+        for ch in range(4):
+            rows = make_channel_rows(src, ch, timeline)
+            cache = self.caches[ch]
+            if cache and cache["rows"] == rows:
+                jobs.append(cache)
+                continue
+            args = (rows, timeline["bars"], self.tones, self.patterns, cache)
+            jobs.append(submit(executor, compile_channel, args))
+        sounds = []
+        for ch, job in enumerate(jobs):
+            cache = get_result(job)
+            self.caches[ch] = cache
+            sounds.append(make_sound(cache["results"]))
+        self.music = sounds
+        self.revision = revision
+        return sounds
+
+    # windowで指定したtick数ごとに、(区切りの番号, 4チャンネル分の再生データ)をyieldする
+    # start_tickを含む区切りから曲の最後まで進んだあと、それより前の区切りを返す
+    # 最後まで進むとキャッシュが更新され、曲全体の再生データがmusicに入る
+    def compile_chunks(
+        self,
+        src,
+        tones,
+        patterns,
+        window=CHUNK_TICKS,
+        revision=None,
+        timeline=None,
+        start_tick=0,
+    ):
+        self.set_tones(tones, patterns)
+        if timeline is None:
+            timeline = make_timeline(src)
+        first = start_tick // window
+        caches = [{}, {}, {}, {}]
+        iterators = []
+        for ch in range(4):
+            rows = make_channel_rows(src, ch, timeline)
+            args = (rows, timeline["bars"], self.tones, self.patterns, self.caches[ch])
+            results = iter_channel(*args, caches[ch])
+            iterators.append(skip_ticks(results, first * window))
+        yield from iter_chunks(iterators, window, first)
+        self.caches = caches
+        self.music = [make_sound(cache["results"]) for cache in caches]
+        self.revision = revision
+        # 開始位置より前の区切りは、コンパイル済みの小節の結果から作る
+        iterators = [iter(cache["results"]) for cache in caches]
+        yield from iter_chunks(iterators, window, 0, first)
+
+    def set_tones(self, tones, patterns):
+        if tones != self.tones or patterns != self.patterns:
+            self.tones = copy.deepcopy(tones)
+            self.patterns = copy.deepcopy(patterns)
+            self.caches = [None, None, None, None]
+            self.revision = None
+
+
+# バッファの先頭からtick数分の再生データを切り出す
+def cut_chunk(buffer, ticks):
+    match = re.match(r"(?:r|[a-g]#?\d){1,%d}" % ticks, buffer["note"])
+    note_end = match.end() if match else 0
+    chunk = [buffer["note"][:note_end]]
+    buffer["note"] = buffer["note"][note_end:]
+    for key in ("tone", "volume", "effect"):
+        chunk.append(buffer[key][:ticks])
+        buffer[key] = buffer[key][ticks:]
+    return chunk + [1]
+
+
+# 小節ごとの結果から、windowのtick数ごとに(区切りの番号, 4チャンネル分の再生データ)を作る
+def iter_chunks(iterators, window, index=0, count=None):
+    buffers = [{"note": "", "tone": "", "volume": "", "effect": ""} for _ in iterators]
+    while count is None or index < count:
+        for ch, buffer in enumerate(buffers):
+            while len(buffer["volume"]) < window:
+                result = next(iterators[ch], None)
+                if result is None:
+                    break
+                for key in buffer:
+                    buffer[key] += result[key]
+        if not buffers[0]["volume"]:
+            break
+        yield (index, [cut_chunk(buffer, window) for buffer in buffers])
+        index += 1
+
+
+# 小節ごとの結果の先頭からtick数分を飛ばす（飛ばした小節もコンパイルはされる）
+def skip_ticks(results, ticks):
+    for result in results:
+        size = len(result["volume"])
+        if ticks >= size:
+            ticks -= size
+            continue
+        if ticks > 0:
+            result = dict(result)
+            cut_chunk(result, ticks)
+            ticks = 0
+        yield result
+
+
+# 各小節の開始tick（wavの合成を小節ごとに区切るのに使う）
+def get_bar_ticks(src):
+    timeline = make_timeline(src)
+    return [int(timeline["ticks"][row] / 48) for row in timeline["bars"]]
+
+
+def submit(executor, func, args):
+    if executor is None:
+        return func(*args)
+    return executor.submit(func, *args)
+
+
+def get_result(job):
+    if isinstance(job, concurrent.futures.Future):
+        return job.result()
+    return job
+
+
+def join_result(result):
+    return {key: "".join(value) for key, value in result.items()}
+
+
+def make_sound(results):
+    note = "".join([result["note"] for result in results])
+    if not note:
+        return None
+    return [
+        note,
+        shorten("".join([result["tone"] for result in results])),
+        shorten("".join([result["volume"] for result in results])),
+        shorten("".join([result["effect"] for result in results])),
+        1,
+    ]
+
+
+# 1チャンネル分のコンパイル（NumPy版）
+# 行データをtick単位の配列に展開し、エンベロープ表を配列演算で引いて出力を作る
+def compile_channel_numpy(rows, tones, patterns):
+    # 行ごとの状態（音色・音量・クオンタイズは前の行から引き継ぐ）
+    combos = {}
+    envelopes = []
+    row_combos = []
+    row_quantizes = []
+    seg_kinds = [SEG_REST]
+    seg_notes = [-1]
+    seg_note_cnts = [0]
+    event_rows = []
+    tone = 0
+    volume = 7
+    quantize = 1.0
+    pattern = None
+    for row, (_, _, tone_val, volume_val, quantize_val, note, note_cnt) in enumerate(
+        rows
+    ):
+        if not tone_val is None:
+            tone = tone_val
+        if not volume_val is None:
+            volume = volume_val
+        if not quantize_val is None:
+            quantize = quantize_val / 16
+        if not note is None:
+            pattern = None
+            for tmp_pattern in patterns:
+                if tmp_pattern["key"] == note:
+                    pattern = tmp_pattern
+            if note == -1:
+                seg_kinds.append(SEG_REST)
+            elif pattern is None:
+                seg_kinds.append(SEG_NOTE)
+            else:
+                seg_kinds.append(SEG_PATTERN)
+            seg_notes.append(note if pattern is None else NOTE_NONE)
+            seg_note_cnts.append(note_cnt)
+            event_rows.append(row)
+        key = (tone, len(event_rows), volume) if pattern else (tone, -1, volume)
+        if not key in combos:
+            combos[key] = len(envelopes)
+            envelopes.append(get_envelope(tones[tone], pattern, volume))
+        row_combos.append(combos[key])
+        row_quantizes.append(quantize)
+    # エンベロープ表を1本の配列につなげる
+    limits = np.array([envelope["limit"] for envelope in envelopes])
+    releases = np.array([envelope["release"] for envelope in envelopes])
+    waves = np.array([ord(envelope["wave"]) for envelope in envelopes], np.uint8)
+    bases = np.cumsum([0] + [envelope["limit"] + 1 for envelope in envelopes])[:-1]
+    volumes_on = []
+    volumes_off = []
+    effects = []
+    pattern_notes = []
+    for envelope in envelopes:
+        volumes_on += [ord(volume) for volume in envelope["volumes_on"]]
+        volumes_off += [ord(volume) for volume in envelope["volumes_off"]]
+        effects += [ord(effect) for effect in envelope["effects"]]
+        pattern_notes += envelope["pattern_notes"] or [0] * (envelope["limit"] + 1)
+    volumes_on = np.array(volumes_on, np.uint8)
+    volumes_off = np.array(volumes_off, np.uint8)
+    effects = np.array(effects, np.uint8)
+    pattern_notes = np.array(pattern_notes, np.int64)
+    # tick単位への展開
+    note_lens = np.array([row[0] for row in rows], np.float64)
+    ticks = np.array([row[1] for row in rows], np.float64)
+    loops = (np.trunc((note_lens + ticks) / 48) - np.trunc(ticks / 48)).astype(np.int64)
+    total = int(loops.sum())
+    if total == 0:
+        return {"note": "", "tone": "", "volume": "", "effect": ""}
+    offsets = np.concatenate(([0], np.cumsum(loops)))
+    row_t = np.repeat(np.arange(len(rows)), loops)
+    tick_t = np.arange(total)
+    is_event = np.zeros(len(rows), np.int64)
+    is_event[event_rows] = 1
+    seg_t = np.cumsum(is_event)[row_t]
+    seg_starts = np.concatenate(([0], offsets[event_rows])).astype(np.int64)
+    seg_kinds = np.array(seg_kinds)
+    start_t = seg_starts[seg_t]
+    kind_t = seg_kinds[seg_t]
+    duration_t = tick_t - start_t + 1
+    # クオンタイズによる発音の打ち切り（区間内で最初に閾値を超えたtickから休符扱い）
+    is_on = kind_t != SEG_REST
+    threshold = (
+        note_lens[row_t]
+        / 48
+        * np.array(seg_note_cnts, np.float64)[seg_t]
+        * np.array(row_quantizes)[row_t]
+    )
+    cut = is_on & (duration_t > threshold)
+    cut_cnt = count_in_segment(cut, start_t)
+    is_rest = ~is_on | (cut_cnt > 0)
+    first_cut = cut & (cut_cnt == 1)
+    cut_starts = np.zeros(len(seg_starts), np.int64)
+    cut_starts[seg_t[first_cut]] = tick_t[first_cut]
+    # 打ち切ったtickの経過は1、次のtickも1から数え直す（putNotesと同じ）
+    duration_t = np.where(
+        is_on & is_rest, np.maximum(tick_t - cut_starts[seg_t], 1), duration_t
+    )
+    # エンベロープ表の参照
+    combo_t = np.array(row_combos)[row_t]
+    limit_t = limits[combo_t]
+    idx = np.where(
+        duration_t <= limit_t, duration_t, limit_t - (duration_t - limit_t) % 2
+    )
+    flat = bases[combo_t] + idx
+    volume_t = np.where(is_rest, volumes_off[flat], volumes_on[flat])
+    # ノート（リリースが終わると-1になり、次のノートまで引き継がれる）
+    killed = count_in_segment(is_rest & (duration_t >= releases[combo_t]), start_t) > 0
+    seg_notes = np.array(seg_notes, np.int64)
+    note_t = np.where(killed, -1, seg_notes[seg_t])
+    note_t = np.where(kind_t == SEG_PATTERN, pattern_notes[flat], note_t)
+    seg_ends = np.concatenate((seg_starts[1:], [total]))
+    carries = []
+    carry = -1
+    list_notes_t = note_t.tolist()
+    list_killed = killed.tolist()
+    for seg, kind in enumerate(seg_kinds.tolist()):
+        if seg > 0 and kind == SEG_REST:
+            carries.append(carry)
         else:
+            carries.append(int(seg_notes[seg]))
+        start = int(seg_starts[seg])
+        end = int(seg_ends[seg])
+        if end > start:
+            if kind == SEG_REST:
+                carry = -1 if list_killed[end - 1] else carries[seg]
+            else:
+                carry = list_notes_t[end - 1]
+        else:
+            carry = carries[seg]
+    rest_note = np.where(killed, -1, np.array(carries, np.int64)[seg_t])
+    note_t = np.where(kind_t == SEG_REST, rest_note, note_t)
+    # 文字列化
+    codes = np.where((kind_t != SEG_PATTERN) & (note_t < 0), NOTE_REST, note_t)
+    (uniques, inverse) = np.unique(codes, return_inverse=True)
+    note_strs = np.array(
+        [
+            "r" if code == NOTE_REST else list_notes[code % 12] + str(code // 12)
+            for code in uniques.tolist()
+        ],
+        object,
+    )
+    return {
+        "note": "".join(note_strs[inverse].tolist()),
+        "tone": waves[combo_t].tobytes().decode(),
+        "volume": volume_t.tobytes().decode(),
+        "effect": effects[flat].tobytes().decode(),
+    }
+
+
+# 区間の先頭から数えたflagの累計
+def count_in_segment(flag, start_t):
+    total = np.cumsum(flag)
+    return total - (total - flag)[start_t]
+
+
+SEG_REST = 0
+SEG_NOTE = 1
+SEG_PATTERN = 2
+NOTE_NONE = -2
+NOTE_REST = 1 << 20
+
+
+# Pyxel再生データの生成
+# backend="numpy"を指定するとNumPy版を使う（NumPyがなければ通常版）
+def compile(src, tones, patterns, backend="python", executor=None):
+    if backend == "numpy" and not np is None:
+        timeline = make_timeline(src)
+        jobs = []
+        for ch in range(4):
+            args = (make_channel_rows(src, ch, timeline), tones, patterns)
+            jobs.append(submit(executor, compile_channel_numpy, args))
+        return [make_sound([get_result(job)]) for job in jobs]
+    return Compiler().compile(src, tones, patterns, executor)
+
+
+# 圧縮形式（ランレングス）の再生データ
+# 同じ文字（ノートは"c#2"などの単位）が続く部分を"c#2{12}"のように表す
+# 展開はplay.py（単体で配布できるように、そちらにだけ置く）
+def compact(music):
+    sounds = []
+    for sound in music:
+        if sound is None:
             sounds.append(None)
-    return sounds
+        else:
+            sounds.append([encode_rle(field) for field in sound[0:4]] + [sound[4]])
+    return {"format": "rle", "sounds": sounds}
+
+
+def encode_rle(s):
+    tokens = re_token.findall(s)
+    result = []
+    idx = 0
+    while idx < len(tokens):
+        token = tokens[idx]
+        count = 1
+        while idx + count < len(tokens) and tokens[idx + count] == token:
+            count += 1
+        run = f"{token}{{{count}}}"
+        result.append(run if len(run) < len(token) * count else token * count)
+        idx += count
+    return "".join(result)
+
+
+re_token = re.compile(r"r|[a-g]#?\d|.")
 
 
 # Pyxel再生データの生成
@@ -0,0 +1,362 @@
+# コンパイル済みの音楽データをPyxelを使わずにNumPyで波形にする（wavエクスポート用）
+# 音色・音量の値はPyxel 2.4以降の標準の音色（pyxel.tones）に合わせている
+import functools
+import hashlib
+import os
+import re
+import tempfile
+import wave
+
+try:
+    import numpy as np
+except:
+    np = None
+
+from system import sounds
+
+SAMPLE_RATE = 22050
+TICKS_PER_SECOND = 120
+# 音量7・ゲイン1.0のときの振幅
+MAX_AMPLITUDE = 4096
+# 小節の指定がないときに区切るtick数
+BLOCK_TICKS = 1200
+# 合成の仕方を変えたら増やす（古いキャッシュを使わないように）
+CACHE_VERSION = 2
+# 引き継ぐ位相の分解能（1周期あたり）
+PHASE_STEPS = 2**20
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+VIBRATO_HZ = 6
+VIBRATO_DEPTH = 0.022
+# ノイズはノートの周波数のNOISE_CLOCK倍で乱数を進める
+NOISE_CLOCK = 4
+NOISE_PERIOD = 32767
+
+# 音色ごとの (波形テーブル, 量子化ビット数, ゲイン)（Nはノイズ）
+TONES = {
+    "t": (
+        [8, 9, 10, 11, 12, 13, 14, 15, 15, 14, 13, 12, 11, 10, 9, 8]
+        + [7, 6, 5, 4, 3, 2, 1, 0, 0, 1, 2, 3, 4, 5, 6, 7],
+        4,
+        1.0,
+    ),
+    "s": ([1, 0], 1, 0.3),
+    "p": ([1, 0, 0, 0], 1, 0.3),
+    "n": (None, 1, 0.6),
+}
+TONE_KEYS = "tspn"
+EFFECT_KEYS = "nsvfhq"
+NOTE_OFFSETS = {"c": 0, "d": 2, "e": 4, "f": 5, "g": 7, "a": 9, "b": 11}
+NOTE_PATTERN = re.compile(r"r|[a-g][#-]?\d")
+SPACE_CODES = np.frombuffer(b" \t\n\r", np.uint8) if np else None
+
+
+@functools.lru_cache(maxsize=1)
+def get_tables():
+    tables = []
+    for key in TONE_KEYS:
+        (table, bits, gain) = TONES[key]
+        if table is None:
+            table = get_noise()
+        else:
+            # 直流成分を除いて-1〜1に合わせる
+            table = np.array(table, np.float64)
+            table = (table - table.mean()) * 2 / (2**bits - 1)
+        tables.append(table * gain)
+    return tables
+
+
+# 15ビットLFSR（長周期）の出力を±1で並べたもの
+def get_noise():
+    reg = 1
+    bits = []
+    for _ in range(NOISE_PERIOD):
+        bits.append(reg & 1)
+        reg = (reg >> 1) | (((reg ^ (reg >> 1)) & 1) << 14)
+    return np.array(bits, np.float64) * 2 - 1
+
+
+# "c#2r..."を音程の配列に（休符は-1）
+def parse_notes(notes):
+    values = get_note_values()
+    return [values[token] for token in NOTE_PATTERN.findall(notes.lower())]
+
+
+# ノートの文字列から音程への対応表
+@functools.lru_cache(maxsize=1)
+def get_note_values():
+    values = {"r": -1}
+    for name, offset in NOTE_OFFSETS.items():
+        for octave in range(10):
+            note = offset + octave * 12
+            values[f"{name}{octave}"] = note
+            values[f"{name}#{octave}"] = note + 1
+            values[f"{name}-{octave}"] = note - 1
+    return values
+
+
+# 文字列をノート数に合わせて繰り返した配列に
+def parse_values(text, keys, count):
+    codes = np.frombuffer(text.lower().encode(), np.uint8)
+    codes = codes[~np.isin(codes, SPACE_CODES)]
+    if len(codes) == 0:
+        return np.zeros(count, np.int64)
+    table = np.full(256, -1, np.int64)
+    table[np.frombuffer(keys.encode(), np.uint8)] = np.arange(len(keys))
+    values = table[codes]
+    if (values < 0).any():
+        raise ValueError(f"Unknown character in {text!r}")
+    return np.resize(values, count)
+
+
+# 1チャンネル分の波形（-1〜1に音量を掛けたもの）
+# 区切り（小節）ごとに合成し、cache_dirがあれば区切りごとの波形を使い回す
+def render_channel(
+    sound, total_ticks, sample_rate=SAMPLE_RATE, bar_ticks=None, cache_dir=None
+):
+    total_samples = total_ticks * sample_rate // TICKS_PER_SECOND
+    # プロセス間で受け渡すのでfloat32で持つ
+    out = np.zeros(total_samples, np.float32)
+    if sound is None:
+        return out
+    (notes, tones, volumes, effects, speed) = sound
+    notes = np.array(parse_notes(notes), np.float64)
+    count = len(notes)
+    tones = parse_values(tones, TONE_KEYS, count)
+    volumes = parse_values(volumes, "01234567", count)
+    effects = parse_values(effects, EFFECT_KEYS, count)
+    speed = speed or 1
+    if bar_ticks is None:
+        bar_ticks = range(0, count * speed, BLOCK_TICKS)
+    firsts = sorted(set([0] + [tick // speed for tick in bar_ticks]))
+    firsts = [first for first in firsts if first < count]
+    # 位相は前の区切りから引き継ぐ
+    phase = 0.0
+    for first, last in zip(firsts, firsts[1:] + [count]):
+        start = first * speed * sample_rate // TICKS_PER_SECOND
+        if start >= total_samples:
+            break
+        # 休符から始まるなら位相は0に戻るので、引き継がなくてよい（キャッシュが当たりやすい）
+        if notes[first] < 0:
+            phase = 0.0
+        # ビブラートは曲の先頭からの時刻で揺らす
+        if (effects[first:last] == 2).any():
+            lfo_offset = VIBRATO_HZ * start % sample_rate
+        else:
+            lfo_offset = 0
+        # スライドは直前のノートの音程から始める
+        args = (
+            notes[first:last],
+            tones[first:last],
+            volumes[first:last],
+            effects[first:last],
+            float(notes[first - 1]) if first > 0 else -1.0,
+            phase,
+            lfo_offset,
+            speed,
+            first * speed * sample_rate % TICKS_PER_SECOND,
+            sample_rate,
+        )
+        result = None
+        if cache_dir:
+            key = get_cache_key(args)
+            result = load_cache(cache_dir, key)
+        if result is None:
+            result = render_segment(*args)
+            if cache_dir:
+                save_cache(cache_dir, key, result)
+        (segment, phase) = result
+        segment = segment[: total_samples - start]
+        out[start : start + len(segment)] = segment
+    return out
+
+
+# 区切り1つ分の波形と、次の区切りに引き継ぐ位相
+# phase: 引き継いだ位相（休符で0に戻す。無音なので途切れは聞こえない）
+# lfo_offset: 区切りの開始位置でのビブラートの位相（×sample_rate）
+# offset: 区切りの開始位置をサンプル数にしたときの端数（×TICKS_PER_SECOND）
+def render_segment(
+    notes,
+    tones,
+    volumes,
+    effects,
+    prev_note,
+    phase,
+    lfo_offset,
+    speed,
+    offset,
+    sample_rate,
+):
+    ticks = np.arange(len(notes) + 1) * speed
+    bounds = (ticks * sample_rate + offset) // TICKS_PER_SECOND
+    lengths = np.diff(bounds)
+    idx = np.repeat(np.arange(len(notes)), lengths)
+    pos = np.arange(bounds[-1])
+    # ノート内の経過割合
+    frac = (pos - bounds[idx]) / np.maximum(lengths[idx], 1)
+    note = notes[idx]
+    effect = effects[idx]
+    is_rest = note < 0
+    mask = effect == 1
+    if mask.any():
+        prev_notes = np.concatenate(([prev_note], notes[:-1]))
+        prev_notes = np.where(prev_notes < 0, notes, prev_notes)
+        prev = prev_notes[idx[mask]]
+        note[mask] = prev + (note[mask] - prev) * frac[mask]
+    freq = 440 * 2 ** ((note - 33) / 12)
+    mask = effect == 2
+    if mask.any():
+        lfo = np.sin(2 * np.pi * (VIBRATO_HZ * pos[mask] + lfo_offset) / sample_rate)
+        freq[mask] *= 1 + VIBRATO_DEPTH * lfo
+    freq[is_rest] = 0
+    steps = freq / sample_rate
+    totals = np.cumsum(steps)
+    phases = totals - steps
+    # 最後の休符からの位相（休符がまだなければ引き継いだ位相から）
+    rests = np.maximum.accumulate(np.where(is_rest, pos, -1))
+    phases -= np.where(rests < 0, -phase, phases[np.maximum(rests, 0)])
+    level = volumes[idx] / 7
+    for key, slope in ((3, 1), (4, 2), (5, 4)):
+        mask = effect == key
+        if mask.any():
+            level[mask] *= np.minimum(1, slope - frac[mask] * slope)
+    level[is_rest] = 0
+    tone = tones[idx]
+    wave_values = np.zeros(len(pos), np.float64)
+    for key, table in enumerate(get_tables()):
+        mask = tone == key
+        if not mask.any():
+            continue
+        size = NOISE_CLOCK if TONE_KEYS[key] == "n" else len(table)
+        wave_values[mask] = table[(phases[mask] * size).astype(np.int64) % len(table)]
+    if len(pos) == 0:
+        next_phase = phase
+    else:
+        next_phase = phases[-1] + steps[-1]
+    return ((wave_values * level).astype(np.float32), quantize_phase(next_phase))
+
+
+# 引き継ぐ位相をキーに含めるので、桁を揃えて丸める（ノイズの周期で折り返す）
+def quantize_phase(phase):
+    return round(phase % NOISE_PERIOD * PHASE_STEPS) / PHASE_STEPS
+
+
+# 区切りの内容と、前から引き継ぐもの（直前のノート・位相・開始位置の端数）から作るキー
+def get_cache_key(args):
+    digest = hashlib.sha1(repr((CACHE_VERSION,) + args[4:]).encode())
+    for values in args[:4]:
+        digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+def load_cache(cache_dir, key):
+    path = os.path.join(cache_dir, key + ".npz")
+    try:
+        with np.load(path) as data:
+            result = (data["segment"], float(data["phase"]))
+        # 最近使ったものを残せるように更新日時を進める
+        os.utime(path)
+    except Exception:
+        return None
+    return result
+
+
+# 並列に書かれることがあるので、一時ファイルに書いてから置き換える
+def save_cache(cache_dir, key, result):
+    (segment, phase) = result
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        (fd, tmp_path) = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fout:
+            np.savez(fout, segment=segment, phase=np.float64(phase))
+        os.replace(tmp_path, os.path.join(cache_dir, key + ".npz"))
+    except OSError:
+        pass
+
+
+# キャッシュの合計がmax_bytesを超えたら、使っていない期間が長いものから消す
+def trim_cache(cache_dir, max_bytes=MAX_CACHE_BYTES):
+    try:
+        entries = [entry for entry in os.scandir(cache_dir) if entry.is_file()]
+    except OSError:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+    total = 0
+    for entry in entries:
+        total += entry.stat().st_size
+        if total > max_bytes:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def get_total_ticks(music):
+    ticks = 0
+    for sound in music:
+        if not sound is None:
+            count = len(NOTE_PATTERN.findall(sound[0].lower()))
+            ticks = max(ticks, count * (sound[4] or 1))
+    return ticks
+
+
+# music: 4チャンネル分の [notes, tones, volumes, effects, speed]（Noneは無音）
+# executorにconcurrent.futuresのExecutorを渡すと、チャンネルごとに並列で合成する
+# bar_ticks: 小節の開始tickのリスト（小節ごとに合成してcache_dirにキャッシュする）
+def render_stems(
+    music, sample_rate=SAMPLE_RATE, executor=None, bar_ticks=None, cache_dir=None
+):
+    if np is None:
+        raise RuntimeError("NumPy is not installed. Install it to render wav files.")
+    total_ticks = get_total_ticks(music)
+    jobs = []
+    for sound in music:
+        args = (sound, total_ticks, sample_rate, bar_ticks, cache_dir)
+        jobs.append(sounds.submit(executor, render_channel, args))
+    return [sounds.get_result(job) for job in jobs]
+
+
+def mixdown(stems):
+    return to_pcm(np.sum(stems, axis=0, dtype=np.float64))
+
+
+def render(
+    music, sample_rate=SAMPLE_RATE, executor=None, bar_ticks=None, cache_dir=None
+):
+    return mixdown(render_stems(music, sample_rate, executor, bar_ticks, cache_dir))
+
+
+def to_pcm(mix):
+    return np.clip(np.round(mix * MAX_AMPLITUDE), -32768, 32767).astype("<i2")
+
+
+def write_wav(pcm, out_path, sample_rate=SAMPLE_RATE):
+    out_dir = os.path.dirname(out_path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    with wave.open(out_path, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        wf.writeframes(pcm.tobytes())
+
+
+# is_stems=Trueならチャンネルごとに <名前>_ch1.wav〜_ch4.wav に書き出す
+def export_wav(
+    music,
+    out_path,
+    sample_rate=SAMPLE_RATE,
+    executor=None,
+    is_stems=False,
+    bar_ticks=None,
+    cache_dir=None,
+):
+    stems = render_stems(music, sample_rate, executor, bar_ticks, cache_dir)
+    if len(stems[0]) == 0:
+        raise RuntimeError("Music duration is zero.")
+    if not is_stems:
+        write_wav(mixdown(stems), out_path, sample_rate)
+        return
+    (base, ext) = os.path.splitext(out_path)
+    for ch, stem in enumerate(stems):
+        if not music[ch] is None:
+            write_wav(to_pcm(stem), f"{base}_ch{ch + 1}{ext}", sample_rate)
@@ -0,0 +1,247 @@
+# 行ごとの小節番号・通算tick・引き継がれた値を差分更新で管理するインデックス
+import array
+import bisect
+import itertools
+
+from system.song import UNSET
+
+BLOCK_ROWS = 64
+# 曲の先頭の状態 (speed, loc_size, tick_size, 小節内tick, 描画用tick)
+FIRST_STATE = (0, 0, 0, 0, 0)
+
+# 編集のたびに増える通し番号（作り直しても戻らない）
+revisions = itertools.count(1)
+
+
+# ブロックごとの増分を持つFenwick木
+class Fenwick:
+    def __init__(self, values):
+        self.size = len(values)
+        self.tree = [0] + list(values)
+        for i in range(1, self.size + 1):
+            j = i + (i & -i)
+            if j <= self.size:
+                self.tree[j] += self.tree[i]
+
+    def add(self, idx, value):
+        idx += 1
+        while idx <= self.size:
+            self.tree[idx] += value
+            idx += idx & -idx
+
+    # idx未満の合計
+    def prefix(self, idx):
+        total = 0
+        while idx > 0:
+            total += self.tree[idx]
+            idx -= idx & -idx
+        return total
+
+
+class Timeline:
+    def __init__(self, items):
+        # items: song.Song
+        self.items = items
+        self.size = 0
+        # 各ブロック先頭の状態 (speed, loc_size, tick_size, 小節内tick, 描画用tick)
+        self.states = []
+        self.exits = []
+        self.block_locs = []
+        self.block_ticks = []
+        self.block_beats = []
+        # 各ブロック内で進む小節数とtick
+        self.dlocs = []
+        self.dticks = []
+        self.make_fenwick()
+        # 列ごとの値が入っている行
+        self.col_rows = [[] for _ in range(19)]
+        # 行ごとの入力済みセル数
+        self.counts = array.array("b")
+        self.count_tree = Fenwick([0] * 1024)
+        # 最終更新番号
+        self.revision = 0
+        self.update(0, len(items) - 1)
+
+    def make_fenwick(self):
+        capacity = max(len(self.states) * 2, 16)
+        self.loc_tree = Fenwick(self.dlocs + [0] * (capacity - len(self.dlocs)))
+        self.tick_tree = Fenwick(self.dticks + [0] * (capacity - len(self.dticks)))
+
+    # ブロック内を走査して相対値を作り直し、出口の状態を返す
+    def scan_block(self, k):
+        (speed, loc_size, tick_size, tick, beat) = self.states[k]
+        (speeds, loc_sizes, tick_sizes) = self.items.cols[0:3]
+        locs = array.array("i")
+        ticks = array.array("q")
+        beat_sizes = array.array("h")
+        beats = array.array("q")
+        loc = 0
+        tick_total = 0
+        for idx in range(k * BLOCK_ROWS, min((k + 1) * BLOCK_ROWS, self.size)):
+            locs.append(loc)
+            ticks.append(tick_total)
+            if speeds[idx] != UNSET:
+                speed = speeds[idx]
+            if loc_sizes[idx] != UNSET:
+                loc_size = loc_sizes[idx]
+            if tick_sizes[idx] != UNSET:
+                tick_size = tick_sizes[idx]
+            tick += tick_size
+            tick_total += speed * tick_size
+            if tick >= loc_size:
+                tick -= loc_size
+                loc += 1
+            # 拍線の描画位置（小節長で割り切れないときはリセットしない）
+            beat += tick_size
+            if beat == loc_size:
+                beat = 0
+            beat_sizes.append(loc_size)
+            beats.append(beat)
+        self.block_locs[k] = locs
+        self.block_ticks[k] = ticks
+        self.block_beats[k] = (beat_sizes, beats)
+        self.exits[k] = (speed, loc_size, tick_size, tick, beat)
+        self.loc_tree.add(k, loc - self.dlocs[k])
+        self.tick_tree.add(k, tick_total - self.dticks[k])
+        self.dlocs[k] = loc
+        self.dticks[k] = tick_total
+        return self.exits[k]
+
+    def update_row(self, row):
+        count = self.items.count(row)
+        self.count_tree.add(row, count - self.counts[row])
+        self.counts[row] = count
+        for col, values in enumerate(self.items.cols):
+            rows = self.col_rows[col]
+            idx = bisect.bisect_left(rows, row)
+            has_row = idx < len(rows) and rows[idx] == row
+            if values[row] == UNSET:
+                if has_row:
+                    del rows[idx]
+            elif not has_row:
+                rows.insert(idx, row)
+
+    # row〜last_rowが変更された（行数の増減も含む）ときに呼ぶ
+    def update(self, row, last_row=None):
+        last_row = row if last_row is None else last_row
+        old_size = self.size
+        size = len(self.items)
+        self.size = size
+        # 列ごとの値・入力済みセル数
+        if size < old_size:
+            for rows in self.col_rows:
+                del rows[bisect.bisect_left(rows, size) :]
+            for idx in range(size, old_size):
+                self.count_tree.add(idx, -self.counts[idx])
+            del self.counts[size:]
+        for idx in range(row, min(last_row + 1, old_size, size)):
+            self.update_row(idx)
+        # 追加された行は末尾に足すだけでよい
+        self.counts.extend(0 for _ in range(size - old_size))
+        for col, values in enumerate(self.items.cols):
+            rows = self.col_rows[col]
+            for idx in range(old_size, size):
+                if values[idx] != UNSET:
+                    rows.append(idx)
+                    self.counts[idx] += 1
+        if size > self.count_tree.size:
+            self.count_tree = Fenwick(list(self.counts) + [0] * size)
+        else:
+            for idx in range(old_size, size):
+                self.count_tree.add(idx, self.counts[idx])
+        # 小節・tick
+        old_blocks = len(self.states)
+        blocks = (size + BLOCK_ROWS - 1) // BLOCK_ROWS
+        for k in range(blocks, old_blocks):
+            self.loc_tree.add(k, -self.dlocs[k])
+            self.tick_tree.add(k, -self.dticks[k])
+        for lst in (
+            self.states,
+            self.exits,
+            self.block_locs,
+            self.block_ticks,
+            self.block_beats,
+        ):
+            del lst[blocks:]
+            lst.extend(None for _ in range(blocks - len(lst)))
+        for lst in (self.dlocs, self.dticks):
+            del lst[blocks:]
+            lst.extend(0 for _ in range(blocks - len(lst)))
+        if blocks > self.loc_tree.size:
+            self.make_fenwick()
+        # 空の曲は、末尾より後ろの行として先頭の状態から数える
+        if blocks == 0:
+            self.revision = next(revisions)
+            return
+        self.states[0] = FIRST_STATE
+        k = min(row, old_size, size - 1) // BLOCK_ROWS
+        last_block = max(min(last_row, size - 1) // BLOCK_ROWS, k)
+        if k < blocks and self.states[k] is None:
+            self.states[k] = self.exits[k - 1]
+        while k < blocks:
+            state = self.scan_block(k)
+            k += 1
+            if k >= blocks:
+                break
+            # 以降のブロックの入口の状態が変わらなければ、増分の更新だけで済む
+            if k > last_block and k < old_blocks and self.states[k] == state:
+                break
+            self.states[k] = state
+        self.revision = next(revisions)
+
+    # 行の小節番号
+    def loc(self, row):
+        if row >= self.size:
+            return self.get_virtual(row)[0]
+        (k, i) = divmod(row, BLOCK_ROWS)
+        return 1 + self.loc_tree.prefix(k) + self.block_locs[k][i]
+
+    # 行の通算tick
+    def tick(self, row):
+        if row >= self.size:
+            return self.get_virtual(row)[1]
+        (k, i) = divmod(row, BLOCK_ROWS)
+        return self.tick_tree.prefix(k) + self.block_ticks[k][i]
+
+    # 行で有効な各チャンネルの音色
+    def tones(self, row):
+        item = self.item(row)
+        return [0 if item[3 + ch * 4] is None else item[3 + ch * 4] for ch in range(4)]
+
+    # 行までに入力された値を引き継いだ行データ
+    def item(self, row):
+        if self.size == 0:
+            return [None] * 19
+        row = min(row, self.size - 1)
+        item = []
+        for col in range(19):
+            rows = self.col_rows[col]
+            idx = bisect.bisect_right(rows, row) - 1
+            item.append(None if idx < 0 else self.items.get(rows[idx], col))
+        return item
+
+    # 行を処理した後の (loc_size, 拍線の描画用tick)
+    def beat(self, row):
+        (k, i) = divmod(row, BLOCK_ROWS)
+        (beat_sizes, beats) = self.block_beats[k]
+        return (beat_sizes[i], beats[i])
+
+    # row〜last_row-1の入力済みセル数
+    def count(self, row, last_row):
+        last_row = min(last_row, self.size)
+        return self.count_tree.prefix(last_row) - self.count_tree.prefix(row)
+
+    # 末尾より後ろの空行は最後の状態を引き継ぐ
+    def get_virtual(self, row):
+        blocks = len(self.states)
+        loc = 1 + self.loc_tree.prefix(blocks)
+        tick_total = self.tick_tree.prefix(blocks)
+        state = self.exits[-1] if self.exits else FIRST_STATE
+        (speed, loc_size, tick_size, tick, _) = state
+        for _ in range(row - self.size):
+            tick += tick_size
+            tick_total += speed * tick_size
+            if tick >= loc_size:
+                tick -= loc_size
+                loc += 1
+        return (loc, tick_total)
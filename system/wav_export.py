@@ -1,8 +1,17 @@
+import array
+import concurrent.futures
+import contextlib
+import multiprocessing
 import os
+import sys
+import threading
+import time
 import wave
 
 import pyxel
 
+from system import synth
+
 try:
     import pyaudio
 except Exception:
@@ -17,6 +26,12 @@ START_DETECT_CONSECUTIVE = 8
 MAX_START_WAIT_SEC = 2.0
 TAIL_GUARD_SEC = 0.5
 PRE_ROLL_SEC = 0.1
+# 小節ごとの合成結果のキャッシュ（空にするとキャッシュしない）
+RENDER_CACHE_DIR = "./user/render_cache"
+# PortAudioの定数（PyAudioがなくても偽のデバイスで録音できるように）
+PA_INT16 = 8
+PA_CONTINUE = 0
+PA_COMPLETE = 1
 
 LOOPBACK_KEYWORDS = (
     "blackhole",
@@ -125,139 +140,293 @@ def _choose_input_device(audio):
     return audio.get_default_input_device_info()["index"]
 
 
-def _detect_start_frame(samples, channels, sample_rate, noise_frames):
-    if not samples:
-        return None
-    total_frames = len(samples) // channels
-    noise_window = min(total_frames, max(1, noise_frames))
-    noise_peak = 0
-    for frame_idx in range(noise_window):
-        base = frame_idx * channels
-        level = 0
-        for ch in range(channels):
-            ch_level = abs(samples[base + ch])
-            if ch_level > level:
-                level = ch_level
-        if level > noise_peak:
-            noise_peak = level
-    # Estimate threshold from pre-roll noise only.
-    threshold = max(START_DETECT_MIN_ABS, noise_peak * 2 + 32)
-    consecutive = 0
-    for frame_idx in range(total_frames):
-        base = frame_idx * channels
-        level = 0
-        for ch in range(channels):
-            ch_level = abs(samples[base + ch])
-            if ch_level > level:
-                level = ch_level
-        if level >= threshold:
-            consecutive += 1
-            if consecutive >= START_DETECT_CONSECUTIVE:
-                return frame_idx - START_DETECT_CONSECUTIVE + 1
-        else:
-            consecutive = 0
-    return None
-
-
-def export_compiled_music_to_wav(compiled_music, out_path):
-    if pyaudio is None:
-        raise RuntimeError(
-            "PyAudio is not installed. Install it to use WAV export recording."
+# 録音の中から再生が始まった位置（大きな音がSTART_DETECT_CONSECUTIVEフレーム続いた先頭）を探す
+# 録音したチャンクを順にfeed()する。閾値は最初のnoise_framesフレームのノイズから決める
+class StartDetector:
+    def __init__(self, channels, noise_frames):
+        self.channels = channels
+        self.noise_frames = max(1, noise_frames)
+        # 閾値が決まるまでのサンプル
+        self.pending = array.array("h")
+        self.threshold = None
+        # 調べ終わったフレーム数と、その最後で大きな音が続いているフレーム数
+        self.frames = 0
+        self.consecutive = 0
+        self.start_frame = None
+
+    # 見つかったら開始位置（録音の先頭からのフレーム数）を返す
+    def feed(self, samples):
+        if not self.start_frame is None:
+            return self.start_frame
+        if self.threshold is None:
+            self.pending.extend(samples)
+            noise = self.pending[: self.noise_frames * self.channels]
+            if len(noise) < self.noise_frames * self.channels:
+                return None
+            noise_peak = max(max(noise), -min(noise))
+            self.threshold = max(START_DETECT_MIN_ABS, noise_peak * 2 + 32)
+            (samples, self.pending) = (self.pending, None)
+        self.scan(samples)
+        return self.start_frame
+
+    def scan(self, samples):
+        channels = self.channels
+        frame_count = len(samples) // channels
+        if frame_count == 0:
+            return
+        # チャンク全体が閾値より小さければ1フレームずつ見なくてよい
+        if max(samples) < self.threshold and -min(samples) < self.threshold:
+            self.consecutive = 0
+            self.frames += frame_count
+            return
+        for frame_idx in range(frame_count):
+            base = frame_idx * channels
+            frame = samples[base : base + channels]
+            level = max(max(frame), -min(frame))
+            if level >= self.threshold:
+                self.consecutive += 1
+                if self.consecutive >= START_DETECT_CONSECUTIVE:
+                    self.start_frame = self.frames + frame_idx + 1 - self.consecutive
+                    break
+            else:
+                self.consecutive = 0
+        self.frames += frame_count
+
+
+# NumPyがなければ（または指定されたら）合成せずに再生音を録音する
+def is_recording():
+    return synth.np is None or os.getenv("PYXEL_TRACKER_WAV_EXPORT") == "loopback"
+
+
+# NumPyがあればオフラインで合成し、なければ（または指定されたら）再生音を録音する
+# is_stems=Trueならチャンネルごとのファイルに書き出す（合成のときのみ）
+# bar_ticksを渡すと小節ごとの波形をキャッシュし、変わった小節だけ合成し直す
+def export_compiled_music_to_wav(
+    compiled_music, out_path, is_stems=False, bar_ticks=None
+):
+    if is_recording():
+        if is_stems:
+            raise RuntimeError("Stem export needs NumPy (offline rendering).")
+        return record_compiled_music_to_wav(compiled_music, out_path)
+    sounds = [
+        _normalize_sound(compiled_music[ch] if ch < len(compiled_music) else None)
+        for ch in range(4)
+    ]
+    cache_dir = None
+    if not bar_ticks is None:
+        cache_dir = os.getenv("PYXEL_TRACKER_RENDER_CACHE_DIR", RENDER_CACHE_DIR)
+    with _make_executor() as executor:
+        synth.export_wav(
+            sounds,
+            out_path,
+            executor=executor,
+            is_stems=is_stems,
+            bar_ticks=bar_ticks,
+            cache_dir=cache_dir,
         )
-    duration_sec = calc_total_seconds(compiled_music)
-    if duration_sec <= 0:
-        raise RuntimeError("Music duration is zero.")
-
-    for ch in range(4):
-        sound = _normalize_sound(compiled_music[ch] if ch < len(compiled_music) else None)
-        if sound is None:
-            continue
-        pyxel.sounds[ch].set(*sound)
-
-    audio = pyaudio.PyAudio()
-    stream = None
-    sample_rate = DEFAULT_SAMPLE_RATE
-    channels = 1
-    try:
-        device_index = _choose_input_device(audio)
-        info = audio.get_device_info_by_index(device_index)
-        sample_rate = int(info.get("defaultSampleRate", DEFAULT_SAMPLE_RATE))
+    if cache_dir:
+        synth.trim_cache(cache_dir)
+
+
+# チャンネルごとに別プロセスで合成する
+# spawnだとeditor.pyが読み込み直されるので、forkを使う
+# macOSなどではスレッドを持ったプロセス（Pyxel）のforkが安全でないため、LinuxでCPUが複数あるときだけ
+def _make_executor():
+    if (os.cpu_count() or 1) < 2 or not sys.platform.startswith("linux"):
+        return contextlib.nullcontext(None)
+    return concurrent.futures.ProcessPoolExecutor(
+        4, mp_context=multiprocessing.get_context("fork")
+    )
+
+
+# 再生音を録音してwavに書き出す
+# PyAudioのコールバックで録音し、Pyxelの操作と書き出しはメインループから呼ぶupdate()で行う
+# audioにはPyAudio互換のオブジェクト（テスト用の偽のデバイスなど）を渡せる
+class Recorder:
+    def __init__(self, compiled_music, out_path, audio=None):
+        self.sounds = [
+            _normalize_sound(compiled_music[ch] if ch < len(compiled_music) else None)
+            for ch in range(4)
+        ]
+        self.out_path = out_path
+        self.audio = audio
+        self.stream = None
+        self.lock = threading.Lock()
+        # 録音したチャンク（開始位置が見つかるまでは、開始位置になりうる部分だけ残す）
+        self.chunks = []
+        # chunks[0]の先頭の、録音の先頭からのフレーム数
+        self.chunks_frame = 0
+        self.frames = 0
+        self.start_frame = None
+        self.total_frames = 0
+        self.is_started = False
+
+    def start(self):
+        if self.audio is None:
+            if pyaudio is None:
+                raise RuntimeError(
+                    "PyAudio is not installed. Install it to use WAV export recording."
+                )
+            self.audio = pyaudio.PyAudio()
+        try:
+            self.open()
+        except:
+            self.close()
+            raise
+
+    def open(self):
+        self.duration_sec = calc_total_seconds(self.sounds)
+        if self.duration_sec <= 0:
+            raise RuntimeError("Music duration is zero.")
+        for ch, sound in enumerate(self.sounds):
+            if not sound is None:
+                pyxel.sounds[ch].set(*sound)
+        device_index = _choose_input_device(self.audio)
+        info = self.audio.get_device_info_by_index(device_index)
+        self.sample_rate = int(info.get("defaultSampleRate", DEFAULT_SAMPLE_RATE))
         max_input_channels = int(info.get("maxInputChannels", 1))
-        channels = 1 if max_input_channels >= 1 else max_input_channels
-        if channels <= 0:
+        self.channels = 1 if max_input_channels >= 1 else max_input_channels
+        if self.channels <= 0:
             raise RuntimeError("Selected input device does not support input channels.")
-
+        capture_sec = (
+            PRE_ROLL_SEC + self.duration_sec + MAX_START_WAIT_SEC + TAIL_GUARD_SEC
+        )
+        self.total_frames = int(capture_sec * self.sample_rate)
+        self.pre_roll_frames = int(PRE_ROLL_SEC * self.sample_rate)
+        self.take_frames = int(self.duration_sec * self.sample_rate)
+        pyxel.stop()
         try:
-            stream = audio.open(
-                format=pyaudio.paInt16,
-                channels=channels,
-                rate=sample_rate,
-                input=True,
-                frames_per_buffer=DEFAULT_CHUNK,
-                input_device_index=device_index,
-            )
+            self.stream = self.open_stream(device_index)
         except Exception:
-            if max_input_channels >= 2:
-                channels = 2
-                stream = audio.open(
-                    format=pyaudio.paInt16,
-                    channels=channels,
-                    rate=sample_rate,
-                    input=True,
-                    frames_per_buffer=DEFAULT_CHUNK,
-                    input_device_index=device_index,
-                )
-            else:
+            if max_input_channels < 2:
                 raise
+            self.channels = 2
+            self.stream = self.open_stream(device_index)
+
+    def open_stream(self, device_index):
+        self.detector = StartDetector(self.channels, self.pre_roll_frames)
+        return self.audio.open(
+            format=PA_INT16,
+            channels=self.channels,
+            rate=self.sample_rate,
+            input=True,
+            frames_per_buffer=DEFAULT_CHUNK,
+            input_device_index=device_index,
+            stream_callback=self.on_chunk,
+        )
 
-        capture_sec = PRE_ROLL_SEC + duration_sec + MAX_START_WAIT_SEC + TAIL_GUARD_SEC
-        total_frames = int(capture_sec * sample_rate)
-        total_chunks = (total_frames + DEFAULT_CHUNK - 1) // DEFAULT_CHUNK
-        pre_roll_frames = int(PRE_ROLL_SEC * sample_rate)
-        pre_roll_chunks = (pre_roll_frames + DEFAULT_CHUNK - 1) // DEFAULT_CHUNK
-
+    # 録音スレッドから呼ばれる
+    def on_chunk(self, in_data, frame_count, time_info, status):
+        samples = array.array("h", in_data)
+        with self.lock:
+            self.chunks.append(samples)
+            self.frames += frame_count
+            if self.start_frame is None:
+                self.find_start(samples)
+            is_full = self.is_full()
+        return (None, PA_COMPLETE if is_full else PA_CONTINUE)
+
+    # 開始位置を探し、それより前の録音を捨てる
+    def find_start(self, samples):
+        self.start_frame = self.detector.feed(samples)
+        if self.start_frame is None:
+            # 閾値を超えて続いている音より前は開始位置にならない
+            keep_frame = self.detector.frames - self.detector.consecutive
+        else:
+            keep_frame = self.start_frame
+        while self.chunks:
+            size = len(self.chunks[0]) // self.channels
+            if self.chunks_frame + size > keep_frame:
+                break
+            self.chunks.pop(0)
+            self.chunks_frame += size
+        if not self.start_frame is None and self.chunks:
+            offset = (self.start_frame - self.chunks_frame) * self.channels
+            self.chunks[0] = self.chunks[0][offset:]
+            self.chunks_frame = self.start_frame
+
+    # 開始位置から曲の長さ分を録り終えたか、録音時間の上限に達したらTrue
+    def is_full(self):
+        if self.frames >= self.total_frames:
+            return True
+        if self.start_frame is None:
+            return False
+        return self.frames - self.start_frame >= self.take_frames
+
+    # 0〜1の進み具合
+    def get_progress(self):
+        with self.lock:
+            frames = self.frames
+        return min(frames / self.total_frames, 1) if self.total_frames else 0
+
+    # 毎フレーム呼ぶ。書き出しまで終わったらTrueを返す
+    def update(self):
+        # 止まったかどうかを先に見る（止まっていれば録音済みのフレーム数は確定している）
+        is_active = self.stream.is_active()
+        with self.lock:
+            frames = self.frames
+            is_full = self.is_full()
+        # 無音を少し録ってから再生を始める（開始位置の検出に使う）
+        if not self.is_started and frames >= self.pre_roll_frames:
+            for ch, sound in enumerate(self.sounds):
+                if not sound is None:
+                    pyxel.play(ch, [ch])
+            self.is_started = True
+        if not is_full:
+            if not is_active:
+                self.cancel()
+                raise RuntimeError("Recording stopped before the end of the music.")
+            return False
+        self.close()
+        self.write()
+        return True
+
+    def cancel(self):
+        self.close()
         pyxel.stop()
 
-        recorded = []
-        for _ in range(pre_roll_chunks):
-            chunk = stream.read(DEFAULT_CHUNK, exception_on_overflow=False)
-            recorded.append(chunk)
-
-        for ch in range(4):
-            if ch < len(compiled_music) and _normalize_sound(compiled_music[ch]) is not None:
-                pyxel.play(ch, [ch])
-
-        for _ in range(total_chunks - pre_roll_chunks):
-            chunk = stream.read(DEFAULT_CHUNK, exception_on_overflow=False)
-            recorded.append(chunk)
-
-        raw = b"".join(recorded)
-        samples = memoryview(raw).cast("h")
-        start_frame = _detect_start_frame(
-            samples, channels, sample_rate, pre_roll_frames
-        )
-        if start_frame is None:
+    def close(self):
+        if not self.stream is None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        if not self.audio is None:
+            self.audio.terminate()
+            self.audio = None
+
+    def write(self):
+        if self.start_frame is None:
             raise RuntimeError(
                 "Failed to detect playback start in recorded input. "
                 "Set a loopback input device (e.g. BlackHole) and retry."
             )
-        start = start_frame * channels
-        take_frames = int(duration_sec * sample_rate)
-        end = start + take_frames * channels
+        with self.lock:
+            samples = array.array("h")
+            for chunk in self.chunks:
+                samples.extend(chunk)
+            self.chunks = []
+        end = self.take_frames * self.channels
         if end > len(samples):
             raise RuntimeError("Recorded data is shorter than calculated duration.")
-        clipped = samples[start:end].tobytes()
+        clipped = samples[:end].tobytes()
 
-        out_dir = os.path.dirname(out_path)
+        out_dir = os.path.dirname(self.out_path)
         if out_dir:
             os.makedirs(out_dir, exist_ok=True)
-        with wave.open(out_path, "wb") as wf:
-            wf.setnchannels(channels)
+        with wave.open(self.out_path, "wb") as wf:
+            wf.setnchannels(self.channels)
             wf.setsampwidth(2)
-            wf.setframerate(sample_rate)
+            wf.setframerate(self.sample_rate)
             wf.writeframes(clipped)
-    finally:
-        if stream is not None:
-            stream.stop_stream()
-            stream.close()
-        audio.terminate()
+
+
+# 録音が終わるまで待つ（エディタからはRecorderを使ってメインループを止めずに録音する）
+def record_compiled_music_to_wav(compiled_music, out_path, audio=None):
+    recorder = Recorder(compiled_music, out_path, audio)
+    recorder.start()
+    try:
+        while not recorder.update():
+            time.sleep(0.01)
+    except:
+        recorder.cancel()
+        raise
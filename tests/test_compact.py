@@ -0,0 +1,41 @@
+# 圧縮形式（ランレングス）の再生データのテスト（リポジトリのルートで `python -m pytest tests` を実行）
+import json
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(ROOT)
+
+import play
+from system import project_file
+from system import sounds
+
+
+def load_json(path):
+    with open(os.path.join(ROOT, path), "rt", encoding="utf-8") as fin:
+        return json.loads(fin.read())
+
+
+# sample.jsonの再生データを圧縮してplay.pyで展開すると元に戻る
+def test_sample_round_trip():
+    items = project_file.load(os.path.join(ROOT, "projects/sample.json")).to_items()
+    tones = load_json("system/tones.json")
+    patterns = load_json("system/patterns.json")
+    music = sounds.compile(items, tones, patterns)
+    compacted = json.loads(json.dumps(sounds.compact(music)))
+    assert play.expand(compacted) == music
+    for sound in music:
+        if not sound is None:
+            for field in sound[0:4]:
+                assert play.decode_rle(sounds.encode_rle(field)) == field
+
+
+def test_short_runs():
+    for s in ("", "r", "c#2c#2", "c#2" * 5 + "r" * 3 + "d4", "0" * 40 + "7", "pstn"):
+        assert play.decode_rle(sounds.encode_rle(s)) == s
+
+
+# 圧縮されていないデータはそのまま使う
+def test_expand_plain():
+    music = [["c2", "p", "7", "n", 1], None, None, None]
+    assert play.expand(music) == music
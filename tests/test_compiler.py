@@ -0,0 +1,65 @@
+# 差分コンパイル（sounds.Compiler）のテスト（リポジトリのルートで `python -m pytest tests` を実行）
+import json
+import os
+import random
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "benchmarks"))
+
+from projects import DRUM_KEYS, make_project
+from system import sounds
+
+
+def load_json(path):
+    with open(os.path.join(ROOT, path), "rt", encoding="utf-8") as fin:
+        return json.loads(fin.read())
+
+
+TONES = load_json("system/tones.json")
+PATTERNS = load_json("system/patterns.json")
+
+
+def random_value(rng, col):
+    if col == 0:
+        return rng.choice([None, 168, 240, 288])
+    if col == 1:
+        return rng.choice([None, 36, 48])
+    if col == 2:
+        return rng.choice([None, 3, 6, 12])
+    kind = (col - 3) % 4
+    if kind == 0:
+        return rng.choice([None, rng.randrange(16)])
+    if kind == 1:
+        return rng.choice([None, rng.randrange(1, 8)])
+    if kind == 2:
+        return rng.choice([None, rng.randrange(8, 17)])
+    return rng.choice([None, -1, rng.randrange(12, 48), rng.choice(DRUM_KEYS)])
+
+
+# 編集のたびに、前回のキャッシュを使ったコンパイルと最初からのコンパイルが一致する
+def test_matches_full_compile():
+    for seed in range(8):
+        rng = random.Random(seed)
+        items = make_project(80, tempo_changes=3, seed=seed)
+        compiler = sounds.Compiler()
+        for _ in range(25):
+            r = rng.random()
+            if r < 0.6:
+                row = rng.randrange(len(items))
+                # 先頭行のヘッダ（speedなど）は消さない
+                if row > 0 and rng.random() < 0.2:
+                    col = rng.randrange(3)
+                else:
+                    col = rng.randrange(3, 19)
+                items[row][col] = random_value(rng, col)
+            elif r < 0.8:
+                rows = make_project(rng.randrange(2, 20), seed=rng.randrange(1000))
+                row = rng.randrange(1, len(items) + 1)
+                items[row:row] = rows[1:]
+            elif len(items) > 2:
+                row = rng.randrange(1, len(items))
+                del items[row : row + rng.randrange(1, 10)]
+            music = compiler.compile(items, TONES, PATTERNS)
+            assert music == sounds.compile(items, TONES, PATTERNS)
@@ -0,0 +1,71 @@
+# アンドゥ・リドゥ履歴のテスト（リポジトリのルートで `python -m pytest tests` を実行）
+import os
+import random
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from system import history
+from system import song
+
+
+def make_items(rows):
+    return song.Song([[None] * 19 for _ in range(rows)])
+
+
+# アンドゥ後に区切りなしで記録された変更（auto_delete_rowsなど）をはさんでも壊れない
+def test_redo_after_edit_without_begin():
+    items = make_items(4)
+    h = history.History()
+    h.begin()
+    h.set_cell(items, 1, 6, 1)
+    h.begin()
+    h.set_cell(items, 3, 6, 2)
+    after_second = items.to_items()
+    items = h.undo(items)[0]
+    h.delete_rows(items, 2, 2)
+    items = h.undo(items)[0]
+    assert items.to_items() == make_items(4).to_items()
+    items = h.redo(items)[0]
+    items = h.redo(items)[0]
+    assert items.to_items() == after_second
+
+
+# 以前の実装（区切りごとに全体を複製する）と同じ状態になる
+def test_matches_snapshots():
+    for seed in range(200):
+        rng = random.Random(seed)
+        items = make_items(4)
+        h = history.History()
+        pool = []
+        redo_items = []
+        for _ in range(60):
+            r = rng.random()
+            current = items.to_items()
+            if r < 0.3:
+                pool.append(current)
+                redo_items = []
+                h.begin()
+                row = rng.randrange(len(items))
+                h.set_cell(items, row, rng.randrange(3, 19), rng.randrange(5))
+            elif r < 0.45:
+                if rng.random() < 0.5 and len(items) > 1:
+                    h.delete_rows(items, rng.randrange(1, len(items)), 1)
+                else:
+                    h.insert_rows(items, len(items), [[None] * 19])
+            elif r < 0.75:
+                result = h.undo(items)
+                if pool:
+                    redo_items.append(current)
+                    items = result[0]
+                    assert items.to_items() == pool.pop()
+                else:
+                    assert result is None
+            else:
+                result = h.redo(items)
+                if redo_items:
+                    pool.append(current)
+                    items = result[0]
+                    assert items.to_items() == redo_items.pop()
+                else:
+                    assert result is None
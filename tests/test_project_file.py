@@ -0,0 +1,63 @@
+# プロジェクトファイル（json形式とバイナリ形式）のテスト（リポジトリのルートで `python -m pytest tests` を実行）
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(ROOT)
+
+from system import project_file
+from system import song
+
+SAMPLE_PATH = os.path.join(ROOT, "projects", "sample.json")
+
+
+def save(items, path):
+    data = project_file.dumps(items, path)
+    mode = "wb" if project_file.is_binary(path) else "wt"
+    with open(path, mode) as fout:
+        fout.write(data)
+
+
+@pytest.mark.parametrize("ext", project_file.EXTENSIONS)
+def test_round_trip(tmp_path, ext):
+    items = project_file.load(SAMPLE_PATH).to_items()
+    # 列を広げる値・キー・値なし
+    items[1][0] = 100000
+    items[2][5] = 1000
+    items[3][18] = 2**40
+    items[4][10] = ":9"
+    items[5][3:7] = [None, -1, ":1", None]
+    path = str(tmp_path / ("project" + ext))
+    save(song.Song(items), path)
+    assert project_file.load(path).to_items() == items
+
+
+@pytest.mark.parametrize("ext", project_file.EXTENSIONS)
+def test_empty(tmp_path, ext):
+    path = str(tmp_path / ("project" + ext))
+    save(song.Song([]), path)
+    assert project_file.load(path).to_items() == []
+
+
+def test_broken(tmp_path):
+    path = str(tmp_path / "project.pxtr")
+    with open(path, "wb") as fout:
+        fout.write(b"JSON")
+    with pytest.raises(ValueError):
+        project_file.load(path)
+
+
+# convert_project.pyでjson→バイナリ→jsonと変換しても同じ内容になる
+def test_convert_sample(tmp_path):
+    binary_path = str(tmp_path / "sample.pxtr")
+    json_path = str(tmp_path / "sample.json")
+    for src, dst in ((SAMPLE_PATH, binary_path), (binary_path, json_path)):
+        subprocess.run(
+            [sys.executable, "convert_project.py", src, dst], cwd=ROOT, check=True
+        )
+    items = project_file.load(SAMPLE_PATH).to_items()
+    assert project_file.load(binary_path).to_items() == items
+    assert project_file.load(json_path).to_items() == items
@@ -0,0 +1,103 @@
+# 録音によるwavエクスポート（wav_export.Recorder）のテスト
+# 偽の入力デバイス（benchmarks/fake_audio.py）を使うので実機はいらない
+import array
+import os
+import sys
+import time
+import wave
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "benchmarks"))
+
+os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pyxel
+from fake_audio import FakeAudio
+from system import wav_export
+
+SAMPLE_RATE = 22050
+DELAY_SEC = 0.2
+# 0.2秒の曲
+MUSIC = [["c2" * 24, "p", "7", "n", 1], None, None, None]
+TAKE_FRAMES = int(24 / wav_export.TICKS_PER_SECOND * SAMPLE_RATE)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def init_pyxel():
+    pyxel.init(64, 64)
+
+
+def make_pcm(frames):
+    return [(1000 + idx % 50) * (1 if idx // 20 % 2 else -1) for idx in range(frames)]
+
+
+# メインループと同じく、終わるまで毎フレームupdate()を呼ぶ
+def run(recorder, timeout=10):
+    recorder.start()
+    limit = time.perf_counter() + timeout
+    try:
+        while not recorder.update():
+            assert time.perf_counter() < limit
+            time.sleep(0.001)
+    except:
+        recorder.cancel()
+        raise
+
+
+def test_record(tmp_path):
+    pcm = make_pcm(TAKE_FRAMES + 5000)
+    out_path = str(tmp_path / "out.wav")
+    recorder = wav_export.Recorder(
+        MUSIC, out_path, FakeAudio(pcm, SAMPLE_RATE, DELAY_SEC)
+    )
+    run(recorder)
+    assert recorder.start_frame == int(DELAY_SEC * SAMPLE_RATE)
+    assert recorder.stream is None
+    with wave.open(out_path, "rb") as wf:
+        assert wf.getnchannels() == 1
+        assert wf.getsampwidth() == 2
+        assert wf.getframerate() == SAMPLE_RATE
+        assert wf.getnframes() == TAKE_FRAMES
+        data = wf.readframes(wf.getnframes())
+    assert data == array.array("h", pcm[:TAKE_FRAMES]).tobytes()
+
+
+def test_cancel(tmp_path):
+    out_path = str(tmp_path / "out.wav")
+    audio = FakeAudio(make_pcm(TAKE_FRAMES), SAMPLE_RATE, is_realtime=True)
+    recorder = wav_export.Recorder(MUSIC, out_path, audio)
+    recorder.start()
+    stream = recorder.stream
+    assert not recorder.update()
+    recorder.cancel()
+    assert recorder.stream is None
+    assert not stream.is_active()
+    frames = recorder.frames
+    time.sleep(0.1)
+    assert recorder.frames == frames
+    assert recorder.frames < recorder.total_frames
+    assert not os.path.exists(out_path)
+
+
+# 失敗はupdate()の例外としてメインループに伝わり、ファイルは書かれない
+def test_stopped_early(tmp_path):
+    out_path = str(tmp_path / "out.wav")
+    audio = FakeAudio(make_pcm(TAKE_FRAMES), SAMPLE_RATE, stop_sec=0.1)
+    recorder = wav_export.Recorder(MUSIC, out_path, audio)
+    with pytest.raises(RuntimeError, match="stopped before the end"):
+        run(recorder)
+    assert recorder.stream is None
+    assert not os.path.exists(out_path)
+
+
+def test_silent_input(tmp_path):
+    out_path = str(tmp_path / "out.wav")
+    recorder = wav_export.Recorder(MUSIC, out_path, FakeAudio([], SAMPLE_RATE))
+    with pytest.raises(RuntimeError, match="Failed to detect playback start"):
+        run(recorder)
+    assert recorder.start_frame is None
+    assert not os.path.exists(out_path)
@@ -0,0 +1,77 @@
+# 列ごとの配列で持つ曲データ（song.Song）のテスト（リポジトリのルートで `python -m pytest tests` を実行）
+import os
+import random
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from system import song
+
+
+def make_items(rng, rows):
+    items = []
+    for _ in range(rows):
+        item = [None] * 19
+        for col in range(19):
+            r = rng.random()
+            if r < 0.3:
+                item[col] = rng.randrange(-1, 60)
+            elif r < 0.4:
+                item[col] = rng.choice([":1", ":2", ":3", ":5"])
+        items.append(item)
+    return items
+
+
+def test_round_trip():
+    for seed in range(20):
+        rng = random.Random(seed)
+        items = make_items(rng, rng.randrange(0, 50))
+        assert song.Song(items).to_items() == items
+        assert song.Song(items).copy().to_items() == items
+
+
+# 1バイト（0列目は2バイト）に入らない値が入ると列を広げる
+def test_widen():
+    items = make_items(random.Random(0), 4)
+    values = song.Song(items)
+    values.set(1, 0, 100000)
+    values.set(2, 5, 1000)
+    items[1][0] = 100000
+    items[2][5] = 1000
+    assert values.cols[0].typecode == "q"
+    assert values.cols[5].typecode == "q"
+    assert values.to_items() == items
+    rows = [[2**40] + [None] * 17 + [-1], [None] * 18 + [300]]
+    values.insert(3, rows)
+    items[3:3] = rows
+    assert values.cols[18].typecode == "q"
+    assert values.to_items() == items
+    assert values.copy().to_items() == items
+
+
+# 値が入っていない・キーの値が、通常の値と取り違えられない
+def test_sentinels():
+    values = song.Song([[None] * 19])
+    for col in range(19):
+        values.set(0, col, -1)
+    assert values.get(0, 3) == -1
+    values.set(0, 3, ":7")
+    values.set(0, 4, None)
+    assert values.cols[3][0] <= song.KEY_BASE
+    assert values.cols[4][0] == song.UNSET
+    assert values[0][3:5] == [":7", None]
+    assert values.count(0) == 18
+
+
+def test_edit():
+    rng = random.Random(1)
+    items = make_items(rng, 30)
+    values = song.Song(items)
+    assert values.delete(5, 3) == items[5:8]
+    del items[5:8]
+    rows = make_items(rng, 4)
+    values.insert(10, rows)
+    items[10:10] = rows
+    assert len(values) == len(items)
+    assert values.to_items() == items
+    assert values[3:6] == items[3:6]
@@ -0,0 +1,107 @@
+# 録音の開始位置の検出（wav_export.StartDetector）のテスト（リポジトリのルートで `python -m pytest tests` を実行）
+import array
+import os
+import random
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from system import wav_export
+
+NOISE_FRAMES = 2205
+
+
+# 1サンプルずつ見る素朴な実装（録音をまとめて調べていた以前の方法）
+def detect_start(samples, channels, noise_frames):
+    levels = [
+        max(abs(value) for value in samples[idx : idx + channels])
+        for idx in range(0, len(samples), channels)
+    ]
+    if len(levels) < noise_frames:
+        return None
+    threshold = max(
+        wav_export.START_DETECT_MIN_ABS, max(levels[:noise_frames]) * 2 + 32
+    )
+    consecutive = 0
+    for frame_idx, level in enumerate(levels):
+        consecutive = consecutive + 1 if level >= threshold else 0
+        if consecutive >= wav_export.START_DETECT_CONSECUTIVE:
+            return frame_idx - consecutive + 1
+    return None
+
+
+# chunk_framesごと（リストなら順に、なければ乱数で決める）に渡して検出する
+def feed(samples, channels, noise_frames, chunk_frames=None, rng=None):
+    detector = wav_export.StartDetector(channels, noise_frames)
+    pos = 0
+    idx = 0
+    start_frame = None
+    while pos < len(samples):
+        if chunk_frames is None:
+            size = rng.randrange(1, 3000)
+        else:
+            size = chunk_frames[idx % len(chunk_frames)]
+        idx += 1
+        start_frame = detector.feed(samples[pos : pos + size * channels])
+        pos += size * channels
+    return start_frame
+
+
+def make_samples(rng, channels, frames, start, noise=8, bursts=()):
+    samples = array.array(
+        "h", [rng.randint(-noise, noise) for _ in range(frames * channels)]
+    )
+    # 閾値を超えても続かない短い音
+    for frame, length in bursts:
+        for idx in range(frame * channels, (frame + length) * channels):
+            samples[idx] = rng.choice([-3000, 3000])
+    if not start is None:
+        for idx in range(start * channels, frames * channels):
+            samples[idx] = rng.choice([-32768, -2000, 2000, 32767])
+    return samples
+
+
+def test_random_chunks():
+    for seed in range(40):
+        rng = random.Random(seed)
+        channels = rng.choice([1, 2])
+        frames = rng.randrange(NOISE_FRAMES, 20000)
+        start = rng.choice([None, rng.randrange(NOISE_FRAMES, frames)])
+        bursts = [
+            (
+                rng.randrange(frames - 10),
+                rng.randrange(1, wav_export.START_DETECT_CONSECUTIVE),
+            )
+            for _ in range(rng.randrange(4))
+        ]
+        noise = rng.choice([8, 200])
+        samples = make_samples(rng, channels, frames, start, noise, bursts)
+        expected = detect_start(samples, channels, NOISE_FRAMES)
+        for _ in range(3):
+            assert feed(samples, channels, NOISE_FRAMES, rng=rng) == expected
+
+
+# 区切りちょうどから始まる・区切りをまたいで続く
+def test_chunk_boundary():
+    rng = random.Random(0)
+    for channels in (1, 2):
+        for start in (4096, 4095, 4100, 4096 - wav_export.START_DETECT_CONSECUTIVE + 1):
+            samples = make_samples(rng, channels, 8192, start)
+            assert detect_start(samples, channels, NOISE_FRAMES) == start
+            assert feed(samples, channels, NOISE_FRAMES, [1024]) == start
+            assert feed(samples, channels, NOISE_FRAMES, [4096, 1, 7]) == start
+
+
+def test_silent():
+    rng = random.Random(0)
+    for channels in (1, 2):
+        samples = make_samples(rng, channels, 20000, None)
+        assert detect_start(samples, channels, NOISE_FRAMES) is None
+        assert feed(samples, channels, NOISE_FRAMES, [1024]) is None
+        assert feed(samples, channels, NOISE_FRAMES, rng=rng) is None
+        assert (
+            feed(
+                array.array("h", [0] * 20000 * channels), channels, NOISE_FRAMES, [1024]
+            )
+            is None
+        )